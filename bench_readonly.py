@@ -0,0 +1,128 @@
+"""
+Benchmark for hzf_readonly.read_fields.
+
+Writes a corpus of synthetic scan files and reads a few fields from each,
+first one file at a time and then with read_fields.  Then reads every
+device field from one file, first serially and then from a pool of threads
+sharing the open file, e.g.::
+
+    python bench_readonly.py 1000 4 8
+
+for 1000 files read with 4 worker processes and one file read from 8 threads.
+"""
+import sys
+import os
+import time
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+import hzf
+import hzf_readonly
+
+FIELDS = [
+    'entry/DAS_logs/counter/liveMonitor',
+    'entry/DAS_logs/counter/counts',
+    'entry/DAS_logs/A3/softPosition',
+    ]
+
+def make_corpus(path, nfiles, npoints=100, ndevices=50):
+    """
+    Write *nfiles* scans of *npoints* with *ndevices* extra devices to
+    *path*.  Writing is slow, so one scan is written and then copied.
+    """
+    template = os.path.join(path, "template.nxz")
+    f = hzf.File(template, "w")
+    entry = hzf.group(f, "entry", "NXentry")
+    das = hzf.group(entry, "DAS_logs", "NXcollection")
+    counter = hzf.group(das, "counter", "NXcollection")
+    hzf.field(counter, "liveMonitor", dtype='int32',
+              data=numpy.random.randint(1000, 2000, npoints))
+    hzf.field(counter, "counts", dtype='int32',
+              data=numpy.random.randint(0, 100, npoints))
+    A3 = hzf.group(das, "A3", "NXcollection")
+    hzf.field(A3, "softPosition", dtype='float32',
+              data=numpy.linspace(0, 10, npoints))
+    for d in range(ndevices):
+        device = hzf.group(das, "device%d"%d, "NXcollection")
+        hzf.field(device, "value", dtype='float32',
+                  data=numpy.random.rand(npoints))
+    f.close()
+    filenames = []
+    for k in range(nfiles):
+        filename = os.path.join(path, "scan%05d.nxz"%k)
+        shutil.copy(template, filename)
+        filenames.append(filename)
+    return filenames
+
+def read_serial(filenames):
+    result = []
+    for filename in filenames:
+        f = hzf_readonly.File(filename)
+        result.append(dict((path, f[path].value) for path in FIELDS))
+        f.close()
+    return result
+
+def read_threaded(filename, paths, threads, repeat=20):
+    """
+    Read *paths* from *filename* *repeat* times using *threads* threads
+    sharing the same open file.  Returns (serial time, threaded time).
+    """
+    f = hzf_readonly.File(filename)
+    try:
+        t0 = time.time()
+        for _ in range(repeat):
+            serial = [f[path].value for path in paths]
+        t_serial = time.time() - t0
+        pool = ThreadPool(threads)
+        try:
+            t0 = time.time()
+            for _ in range(repeat):
+                threaded = pool.map(lambda path: f[path].value, paths)
+            t_threaded = time.time() - t0
+        finally:
+            pool.close()
+            pool.join()
+        for a, b in zip(serial, threaded):
+            assert (a == b).all()
+    finally:
+        f.close()
+    return t_serial, t_threaded
+
+def main():
+    nfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    path = tempfile.mkdtemp()
+    try:
+        t0 = time.time()
+        filenames = make_corpus(path, nfiles)
+        print("wrote %d files in %.2f s"%(nfiles, time.time()-t0))
+
+        t0 = time.time()
+        serial = read_serial(filenames)
+        t_serial = time.time() - t0
+        print("serial:       %.2f s (%.1f files/s)"%(t_serial, nfiles/t_serial))
+
+        t0 = time.time()
+        batch = hzf_readonly.read_fields(filenames, FIELDS, workers=workers)
+        t_batch = time.time() - t0
+        print("read_fields:  %.2f s (%.1f files/s)"%(t_batch, nfiles/t_batch))
+
+        errors = [(filename, error) for filename, _, error in batch if error is not None]
+        assert not errors, errors[0]
+        for a, (_, b, _) in zip(serial, batch):
+            for k in FIELDS:
+                assert (a[k] == b[k]).all()
+
+        paths = ['entry/DAS_logs/device%d/value'%d for d in range(50)]
+        t_serial, t_threaded = read_threaded(filenames[0], paths, threads)
+        print("one file, serial:      %.2f s"%t_serial)
+        print("one file, %2d threads:  %.2f s"%(threads, t_threaded))
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+Catalog of the entries in a directory of NeXus zip files.
+
+The catalog is an SQLite database with a row for each entry, giving its
+start and end times, program name and collection time, along with the
+NX_class of each group and the shape and type of each field in the entry.
+Queries against the catalog find entries without opening the archives::
+
+    cat = Catalog("catalog.db")
+    cat.update("/data/experiment")
+    for path, entry in cat.query(program_name="NICE",
+                                 start="2016-01-01T00:00:00",
+                                 field="DAS_logs/counter/liveMonitor"):
+        ...
+
+:meth:`Catalog.update` only reads the files which are new or whose size or
+modification time has changed since they were last cataloged.  Files which
+could not be read are recorded, and are not read again until they change.
+"""
+import os
+import json
+import sqlite3
+
+import hzf_readonly
+import iso8601
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL);
+CREATE TABLE IF NOT EXISTS errors (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    error TEXT);
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT,
+    entry TEXT,
+    start_time REAL,
+    end_time REAL,
+    program_name TEXT,
+    collection_time REAL,
+    PRIMARY KEY (path, entry));
+CREATE TABLE IF NOT EXISTS groups (
+    path TEXT,
+    entry TEXT,
+    name TEXT,
+    nx_class TEXT);
+CREATE TABLE IF NOT EXISTS fields (
+    path TEXT,
+    entry TEXT,
+    name TEXT,
+    shape TEXT,
+    dtype TEXT);
+CREATE INDEX IF NOT EXISTS entries_program ON entries (program_name, start_time);
+CREATE INDEX IF NOT EXISTS entries_start ON entries (start_time);
+CREATE INDEX IF NOT EXISTS groups_class ON groups (nx_class, path, entry);
+CREATE INDEX IF NOT EXISTS fields_name ON fields (name, path, entry);
+CREATE INDEX IF NOT EXISTS groups_path ON groups (path);
+CREATE INDEX IF NOT EXISTS fields_path ON fields (path);
+"""
+
+EXTENSIONS = ('.nxz', '.nxs', '.zip')
+
+class Catalog(object):
+    """
+    Entry catalog stored in the SQLite database *filename*.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        # transactions are started explicitly so that each file can be
+        # added within a savepoint, and rolled back alone if it fails
+        self.db = sqlite3.connect(filename, isolation_level=None)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, datadir, extensions=EXTENSIONS):
+        """
+        Catalog the files below *datadir* with one of the *extensions*.
+        Files which are unchanged since the last update are skipped, and
+        files which no longer exist are dropped.  Returns the number of
+        files read, and a list of (path, exception) for files which could
+        not be read.  Files which failed before are skipped until their
+        size or modification time changes; see :meth:`failures`.
+        """
+        seen = set()
+        known = dict((path, (size, mtime)) for path, size, mtime
+                     in self.db.execute("SELECT path, size, mtime FROM files"))
+        failed = dict((path, (size, mtime)) for path, size, mtime
+                      in self.db.execute("SELECT path, size, mtime FROM errors"))
+        count, errors = 0, []
+        with self.db:
+            self.db.execute("BEGIN")
+            for root, _dirs, files in os.walk(datadir):
+                for name in files:
+                    if not name.endswith(extensions):
+                        continue
+                    path = os.path.abspath(os.path.join(root, name))
+                    seen.add(path)
+                    st = os.stat(path)
+                    if (st.st_size, st.st_mtime) in (known.get(path, None), failed.get(path, None)):
+                        continue
+                    self.db.execute("SAVEPOINT catalog_file")
+                    try:
+                        self._drop(path)
+                        self._add(path)
+                        self.db.execute("INSERT INTO files VALUES (?, ?, ?)",
+                                        (path, st.st_size, st.st_mtime))
+                    except Exception as exc:
+                        # drop the rows of the file added before the error,
+                        # leaving its previous rows, if any, in place
+                        self.db.execute("ROLLBACK TO catalog_file")
+                        self.db.execute("INSERT OR REPLACE INTO errors VALUES (?, ?, ?, ?)",
+                                        (path, st.st_size, st.st_mtime,
+                                         "%s: %s" % (exc.__class__.__name__, exc)))
+                        errors.append((path, exc))
+                        continue
+                    finally:
+                        self.db.execute("RELEASE catalog_file")
+                    count += 1
+            prefix = os.path.join(os.path.abspath(datadir), '')
+            for path in set(known) | set(failed):
+                if path.startswith(prefix) and path not in seen:
+                    self._drop(path)
+        return count, errors
+
+    def query(self, program_name=None, start=None, end=None,
+              field=None, nx_class=None):
+        """
+        Return (path, entry) for the entries matching all of the criteria:
+
+        *program_name* is the program which wrote the entry.
+
+        *start*, *end* select entries which started at or after *start* and
+        ended at or before *end*.  Times are ISO 8601 strings or seconds
+        since the epoch.
+
+        *field* is the path of a field in the entry, such as
+        'DAS_logs/counter/liveMonitor'.
+
+        *nx_class* is the NX_class of a group in the entry.
+        """
+        sql = ["SELECT path, entry FROM entries WHERE 1"]
+        args = []
+        if program_name is not None:
+            sql.append("AND program_name = ?")
+            args.append(program_name)
+        if start is not None:
+            sql.append("AND start_time >= ?")
+            args.append(_seconds(start))
+        if end is not None:
+            sql.append("AND end_time <= ?")
+            args.append(_seconds(end))
+        if field is not None:
+            sql.append("AND EXISTS (SELECT 1 FROM fields f WHERE f.name = ?"
+                       " AND f.path = entries.path AND f.entry = entries.entry)")
+            args.append(field.strip('/'))
+        if nx_class is not None:
+            sql.append("AND EXISTS (SELECT 1 FROM groups g WHERE g.nx_class = ?"
+                       " AND g.path = entries.path AND g.entry = entries.entry)")
+            args.append(nx_class)
+        sql.append("ORDER BY start_time, path, entry")
+        return [(str(path), str(entry))
+                for path, entry in self.db.execute(" ".join(sql), args)]
+
+    def failures(self):
+        """
+        Return (path, error message) for the files which could not be read
+        when they were last updated.
+        """
+        return [(str(path), str(error)) for path, error
+                in self.db.execute("SELECT path, error FROM errors ORDER BY path")]
+
+    def fields(self, path, entry):
+        """
+        Return {field path: (shape, dtype)} for the entry.
+        """
+        rows = self.db.execute("SELECT name, shape, dtype FROM fields"
+                               " WHERE path = ? AND entry = ?",
+                               (os.path.abspath(path), entry))
+        return dict((str(name), (json.loads(shape), str(dtype)))
+                    for name, shape, dtype in rows)
+
+    def _drop(self, path):
+        for table in ('files', 'errors', 'entries', 'groups', 'fields'):
+            self.db.execute("DELETE FROM %s WHERE path = ?"%table, (path,))
+
+    def _add(self, path):
+        f = hzf_readonly.File(path)
+        try:
+            names = f.zipfile.namelist()
+            attrs = dict((name[:-len('.attrs')], json.loads(f.read(name)))
+                         for name in names if name.endswith('.attrs'))
+            links = _links(f, names, attrs)
+            entries = [name.rstrip('/') for name, a in attrs.items()
+                       if name.count('/') == 1 and name.endswith('/')
+                       and a.get('NX_class', None) == 'NXentry']
+            for entry in entries:
+                prefix = entry + '/'
+                row = [path, entry,
+                       _entry_time(f, attrs, prefix+'start_time'),
+                       _entry_time(f, attrs, prefix+'end_time'),
+                       _entry_value(f, attrs, prefix+'program_name'),
+                       _entry_value(f, attrs, prefix+'collection_time')]
+                self.db.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)", row)
+                for name, a in attrs.items():
+                    if not name.startswith(prefix):
+                        continue
+                    if name.endswith('/'):
+                        if 'NX_class' in a:
+                            self.db.execute("INSERT INTO groups VALUES (?, ?, ?, ?)",
+                                            (path, entry, name[len(prefix):].rstrip('/'),
+                                             a['NX_class']))
+                    else:
+                        if name in links:
+                            continue
+                        self.db.execute("INSERT INTO fields VALUES (?, ?, ?, ?, ?)",
+                                        (path, entry, name[len(prefix):],
+                                         json.dumps(a.get('shape', None)),
+                                         a.get('dtype', None)))
+                for name, target in links.items():
+                    if not name.startswith(prefix) or target not in attrs:
+                        continue
+                    a = attrs[target]
+                    self.db.execute("INSERT INTO fields VALUES (?, ?, ?, ?, ?)",
+                                    (path, entry, name[len(prefix):],
+                                     json.dumps(a.get('shape', None)),
+                                     a.get('dtype', None)))
+        finally:
+            f.close()
+
+def _links(f, names, attrs):
+    """
+    Return {link path: target path} for the fields which are links, either
+    as .link members or as fields whose attrs give a different target.
+    Links to links are followed to the final target.
+    """
+    links = {}
+    for name in names:
+        if name.endswith('.link'):
+            links[name[:-len('.link')]] = json.loads(f.read(name))['target'].strip('/')
+    for name, a in attrs.items():
+        target = a.get('target', None)
+        if not name.endswith('/') and target and target.strip('/') != name:
+            links.setdefault(name, target.strip('/'))
+    for name, target in links.items():
+        seen = set([name])
+        while target in links and target not in seen:
+            seen.add(target)
+            target = links[target]
+        links[name] = target
+    return links
+
+def _entry_value(f, attrs, name):
+    if name not in attrs:
+        return None
+    value = f['/'+name].value[0]
+    if isinstance(value, bytes) and bytes is not str:
+        value = value.decode('utf-8')
+    return value.item() if hasattr(value, 'item') else value
+
+def _entry_time(f, attrs, name):
+    """
+    Seconds since the epoch for a start_time/end_time field, using the
+    epoch_ms attribute if the writer recorded it.
+    """
+    if name not in attrs:
+        return None
+    if 'epoch_ms' in attrs[name]:
+        return 0.001*attrs[name]['epoch_ms']
+    return iso8601.seconds_since_epoch(_entry_value(f, attrs, name))
+
+def _seconds(t):
+    if isinstance(t, (int, float)):
+        return float(t)
+    return iso8601.seconds_since_epoch(t)
@@ -1,7 +1,9 @@
-import os, sys
+import os, sys, time, stat
 import zipfile, tempfile, shutil
+import struct, zlib
+import multiprocessing
 from json_backed_dict import JSONBackedDict
-import numpy
+import numpy, json
 import iso8601
 
 if bytes != str:
@@ -14,6 +16,10 @@ __version__ = "0.0.1"
 
 builtin_open = __builtins__['open']
 
+# Working trees written to an archive by this process:
+#    os_path: (archive path, archive size, archive mtime, {member: (CRC, size)})
+_WORKING_TREES = {}
+
 class Node(object):
     _attrs_filename = ".attrs"
     
@@ -101,7 +107,7 @@ class Node(object):
         Group(self, path, nxclass, attrs)
 
 class File(Node):
-    def __init__(self, filename, mode="r", timestamp=None, creator=None, compression=zipfile.ZIP_DEFLATED, attrs={}, os_path=None, **kw):
+    def __init__(self, filename, mode="r", timestamp=None, creator=None, compression=zipfile.ZIP_DEFLATED, attrs={}, os_path=None, archiver=None, **kw):
         if os_path is None:
             fn = tempfile.mkdtemp()
             self.os_path = fn
@@ -112,9 +118,12 @@ class File(Node):
         self.filename = filename
         self.mode = mode
         self.compression = compression
+        # ArchiveWorker to write the archive, and the seconds it took
+        self.archiver = archiver
+        self.archive_seconds = None
         file_exists = os.path.exists(filename)
         if file_exists and (mode == "a" or mode == "r"):
-             zipfile.ZipFile(filename).extractall(self.os_path)
+             extract_changed(filename, self.os_path)
         
         if mode == "a" or mode == "w":
             #os.mkdir(os.path.join(self.os_path, self.path.lstrip("/")))
@@ -149,9 +158,27 @@ class File(Node):
             if self.mode != "r":
                 self.writezip()
             shutil.rmtree(self.os_path)
+            _WORKING_TREES.pop(os.path.abspath(self.os_path), None)
         
-    def writezip(self):
-        make_zipfile(self.filename, os.path.join(self.os_path, self.path.lstrip("/")), self.compression)
+    def writezip(self, stream=None):
+        """
+        Write the working tree to the archive, or to the writable *stream*
+        if it is given, using :func:`stream_zipfile`.
+        """
+        source_dir = os.path.join(self.os_path, self.path.lstrip("/"))
+        if stream is not None:
+            stream_zipfile(stream, source_dir, self.compression)
+            return
+        if self.archiver is not None:
+            members, self.archive_seconds = self.archiver.make_zipfile(
+                self.filename, source_dir, self.compression)
+        else:
+            members = make_zipfile(self.filename, source_dir, self.compression)
+        # Remember what was written so that the tree can be reused if the
+        # archive is reopened into it.
+        st = os.stat(self.filename)
+        _WORKING_TREES[os.path.abspath(self.os_path)] = (
+            os.path.abspath(self.filename), st.st_size, st.st_mtime, members)
         #shutil.rmtree(self.os_path)
         
     
@@ -295,7 +322,9 @@ class FieldFile(object):
             pass
         else:
             data = kw.pop('data', numpy.array([]))
-            attrs = kw.pop('attrs', {})
+            # copy so that the caller's attrs (possibly shared between
+            # fields) don't pick up the defaults for this field
+            attrs = dict(kw.pop('attrs', {}))
             attrs.setdefault('description', kw.setdefault('description', None))
             attrs.setdefault('dtype', kw.setdefault('dtype', None))
             attrs.setdefault('units', kw.setdefault('units', None))
@@ -350,12 +379,19 @@ class FieldFile(object):
             if attrs.get('binary', False) == True:
                 d = numpy.fromfile(infile, dtype=attrs['format'])
             else:
-                if os.path.getsize(target) == 1:
+                dtype = numpy.dtype(str(attrs['format']))
+                if dtype.kind == 'S' and len(attrs.get('shape', [])) <= 1:
+                    # one string per line; strings may be empty or contain
+                    # spaces, so don't let loadtxt split them.
+                    lines = infile.read().split(b'\n')
+                    if lines and lines[-1] == b'': lines.pop()
+                    d = numpy.array(lines, dtype=dtype)
+                elif os.path.getsize(target) == 1:
                     # empty entry: only contains \n
                     # this is only possible with empty string being written.
-                    d = numpy.array([''], dtype=numpy.dtype(str(attrs['format'])))
+                    d = numpy.array([''], dtype=dtype)
                 else:
-                    d = numpy.loadtxt(infile, dtype=numpy.dtype(str(attrs['format'])))
+                    d = numpy.loadtxt(infile, dtype=dtype)
         if 'shape' in attrs:
             d = d.reshape(attrs['shape'])
         return d              
@@ -368,7 +404,7 @@ class FieldFile(object):
         if hasattr(data, 'dtype'): 
             formatstr = '<' if attrs['byteorder'] == 'little' else '>'
             formatstr += data.dtype.char
-            formatstr += "%d" % (data.dtype.itemsize,)
+            formatstr += "%d" % (self._stored_itemsize(data),)
             attrs['format'] = formatstr            
             attrs['dtype'] = data.dtype.name
         
@@ -385,13 +421,18 @@ class FieldFile(object):
         else:            
             with builtin_open(target, mode) as outfile:
                 if data.dtype.kind == 'S':
-                    kind = data.dtype.kind
-                    # escape carriage returns and tabs
-                    data = numpy.char.replace(data, '\t', r'\t').astype(kind)
-                    data = numpy.char.replace(data, '\r', r'\r').astype(kind)
-                    data = numpy.char.replace(data, '\n', r'\n').astype(kind)
+                    data = _escape_strings(data)
                 numpy.savetxt(outfile, data, delimiter='\t', fmt=self._formats[data.dtype.kind])
                 
+    def _stored_itemsize(self, data):
+        """
+        Size of the items of *data* as stored, which for text strings
+        includes the escapes for tabs and line breaks.
+        """
+        if data.dtype.kind == 'S' and not self.attrs.get('binary', False) and data.size:
+            return max(data.dtype.itemsize, _escape_strings(data).dtype.itemsize)
+        return data.dtype.itemsize
+
     def append(self, data, coerce_dtype=True):
         # add to the data...
         # can only append along the first axis, e.g. if shape is (3,4)
@@ -420,11 +461,29 @@ class FieldFile(object):
         #    else:
         #        data = data.astype(attrs['dtype'])
                 
+        if data.dtype.kind == 'S' and 'format' in attrs:
+            # widen the stored string format so that longer strings
+            # are not truncated on read
+            itemsize = self._stored_itemsize(data)
+            if itemsize > numpy.dtype(str(attrs['format'])).itemsize:
+                attrs['format'] = attrs['format'][0] + "S%d" % (itemsize,)
+                
         new_shape = list(attrs['shape'])
         new_shape[0] += data.shape[0]
         attrs['shape'] = new_shape
         self._write_data(data, "a")
 
+def _escape_strings(data):
+    """
+    Escape the carriage returns, tabs and newlines in the string array
+    *data* so that each string is written on one line.
+    """
+    kind = data.dtype.kind
+    data = numpy.char.replace(data, '\t', r'\t').astype(kind)
+    data = numpy.char.replace(data, '\r', r'\r').astype(kind)
+    data = numpy.char.replace(data, '\n', r'\n').astype(kind)
+    return data
+
 class FieldLink(FieldFile):
     def __init__(self, node, path, target_path=None, **kw):
         if not path.startswith("/"):
@@ -498,6 +557,27 @@ def make_link(node, path, target_path=None):
     preexisting = os.path.exists(os.path.join(os_path, orig_path.lstrip("/")))
     if not preexisting:
         builtin_open(os.path.join(os_path, orig_path.lstrip("/")), "w").write("soft link: see .link file for target")
+
+def make_links(node, links):
+    """
+    Create a batch of links given as (target_path, link_path) pairs of
+    absolute paths.  Links to links are resolved to the final target, and
+    links to targets which don't exist are skipped.
+    """
+    os_path = node.os_path
+    for target_path, link_path in links:
+        target_os_path = os.path.join(os_path, target_path.lstrip("/"))
+        while os.path.exists(target_os_path + ".link"):
+            with builtin_open(target_os_path + ".link") as infile:
+                target_path = json.loads(infile.read())['target']
+            target_os_path = os.path.join(os_path, target_path.lstrip("/"))
+        if not os.path.exists(target_os_path):
+            continue
+        link_os_path = os.path.join(os_path, link_path.lstrip("/"))
+        with builtin_open(link_os_path + ".link", "w") as outfile:
+            outfile.write(json.dumps({'target': target_path}))
+        if not os.path.exists(link_os_path):
+            builtin_open(link_os_path, "w").write("soft link: see .link file for target")
             
 
 
@@ -592,6 +672,10 @@ def annotate_exception(msg, exc=None):
     exc.args = tuple([arg0] + list(args[1:]))
         
 def make_zipfile(output_filename, source_dir, compression=zipfile.ZIP_DEFLATED):
+    """
+    Write the tree *source_dir* to the archive *output_filename*, returning
+    the {member: (CRC, size)} map of the members written.
+    """
     relroot = os.path.abspath(source_dir)
     try: 
         zipped = zipfile.ZipFile(output_filename, "w", compression)
@@ -605,6 +689,240 @@ def make_zipfile(output_filename, source_dir, compression=zipfile.ZIP_DEFLATED):
                 write_item(zipped, relroot, filename)
     finally:
         zipped.close()
+    return dict((info.filename, (info.CRC, info.file_size))
+                for info in zipped.infolist())
+
+def stream_zipfile(stream, source_dir, compression=zipfile.ZIP_DEFLATED):
+    """
+    Write the tree *source_dir* as an archive to *stream*, returning the
+    {member: (CRC, size)} map of the members written, as for
+    :func:`make_zipfile`.  The stream need only have a write method.
+    """
+    relroot = os.path.abspath(source_dir)
+    zipped = StreamZipFile(stream, compression)
+    try:
+        for root, dirs, files in os.walk(source_dir):
+            for d in dirs:
+                write_item(zipped, relroot, os.path.join(root, d))
+            for f in files:
+                write_item(zipped, relroot, os.path.join(root, f))
+    finally:
+        zipped.close()
+    return dict((info.filename, (info.CRC, info.file_size))
+                for info in zipped.infolist())
+
+class StreamZipFile(object):
+    """
+    Zip archive written to a stream which can't seek, such as a pipe or a
+    socket.
+
+    zipfile goes back to fill in the CRC and sizes in the header of each
+    member once it has been compressed.  Here the header is written with
+    the data descriptor flag set and the CRC and sizes follow the data
+    instead, so each member is sent as it is compressed.  The central
+    directory is written on :meth:`close`.  Only the write and writestr
+    methods of ZipFile are provided.  Archives needing zip64 extensions,
+    with more than 65535 members or with sizes or offsets past 2 GB, are
+    not supported and raise zipfile.LargeZipFile.
+    """
+    chunk_size = 1<<16
+
+    def __init__(self, stream, compression=zipfile.ZIP_DEFLATED):
+        self.stream = stream
+        self.compression = compression
+        self.offset = 0
+        self.members = []
+
+    def write(self, filename, arcname=None):
+        st = os.stat(filename)
+        if arcname is None:
+            arcname = filename
+        arcname = os.path.normpath(os.path.splitdrive(arcname)[1]).lstrip(os.sep)
+        isdir = stat.S_ISDIR(st.st_mode)
+        if isdir:
+            arcname += '/'
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+        if isdir:
+            zinfo.external_attr |= 0x10
+            self._write_member(zinfo, [])
+        else:
+            zinfo.compress_type = self.compression
+            with builtin_open(filename, "rb") as infile:
+                self._write_member(zinfo, iter(lambda: infile.read(self.chunk_size), b''))
+
+    def writestr(self, zinfo, data):
+        if not isinstance(zinfo, zipfile.ZipInfo):
+            zinfo = zipfile.ZipInfo(zinfo, time.localtime(time.time())[0:6])
+            zinfo.compress_type = self.compression
+            zinfo.external_attr = 0o600 << 16
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self._write_member(zinfo, [data])
+
+    def infolist(self):
+        return list(self.members)
+
+    def close(self):
+        if self.stream is None:
+            return
+        start = self.offset
+        for zinfo in self.members:
+            filename, flag_bits = zinfo._encodeFilenameFlags()
+            dt = zinfo.date_time
+            dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+            dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+            self._send(struct.pack(zipfile.structCentralDir,
+                zipfile.stringCentralDir, zinfo.create_version,
+                zinfo.create_system, zinfo.extract_version, zinfo.reserved,
+                flag_bits, zinfo.compress_type, dostime, dosdate,
+                zinfo.CRC, zinfo.compress_size, zinfo.file_size,
+                len(filename), len(zinfo.extra), len(zinfo.comment),
+                0, zinfo.internal_attr, zinfo.external_attr,
+                zinfo.header_offset))
+            self._send(filename + zinfo.extra + zinfo.comment)
+        # the end record holds the offset and size of the central directory,
+        # both of which are below the offset past it
+        self._check_size(self.offset)
+        count = len(self.members)
+        self._send(struct.pack(zipfile.structEndArchive,
+            zipfile.stringEndArchive, 0, 0, count, count,
+            self.offset - start, start, 0))
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+        self.stream = None
+
+    def _write_member(self, zinfo, chunks):
+        """
+        Write *zinfo* and the data in the iterable *chunks*, compressing it
+        and computing the CRC as it goes.
+        """
+        # the member count in the end record is 16 bits
+        if len(self.members) >= 0xFFFF:
+            raise zipfile.LargeZipFile("streamed archives can't hold more than 65535 members")
+        zinfo.header_offset = self._check_size(self.offset)
+        isdir = zinfo.filename.endswith('/')
+        if isdir:
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.flag_bits |= 0x08
+        zinfo.CRC = zinfo.compress_size = zinfo.file_size = 0
+        self._send(zinfo.FileHeader())
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        else:
+            compressor = None
+        crc = 0
+        for chunk in chunks:
+            zinfo.file_size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            zinfo.compress_size += len(chunk)
+            self._send(chunk)
+        if compressor is not None:
+            chunk = compressor.flush()
+            zinfo.compress_size += len(chunk)
+            self._send(chunk)
+        zinfo.CRC = crc & 0xffffffff
+        self._check_size(zinfo.file_size)
+        self._check_size(zinfo.compress_size)
+        if not isdir:
+            self._send(struct.pack("<4sLLL", b"PK\x07\x08",
+                zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+        self.members.append(zinfo)
+
+    def _send(self, data):
+        if data:
+            self.stream.write(data)
+            self.offset += len(data)
+
+    def _check_size(self, size):
+        if size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile("streamed archives can't use zip64 extensions")
+        return size
+
+def zip_file(output_filename, filename, arcname, compression=zipfile.ZIP_DEFLATED):
+    """
+    Write the single file *filename* to the archive *output_filename*.
+    """
+    zipped = zipfile.ZipFile(output_filename, "w", compression)
+    try:
+        zipped.write(filename, arcname)
+    finally:
+        zipped.close()
+
+def _timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+class ArchiveWorker(object):
+    """
+    Helper process which writes archives.
+
+    Walking the working tree, computing the CRCs and compressing the
+    members holds the interpreter lock for much of the time it takes to
+    write an archive.  Files opened with *archiver* set to a worker send
+    the work to the helper process instead, and wait for it without
+    holding the lock, so other threads keep running.  One worker can
+    serve any number of files; requests are handled in the order they
+    arrive.  Call :meth:`close` when done.
+    """
+    def __init__(self, processes=1):
+        self.pool = multiprocessing.Pool(processes=processes)
+
+    def make_zipfile(self, output_filename, source_dir, compression=zipfile.ZIP_DEFLATED):
+        """
+        Write the tree *source_dir* to *output_filename*, returning the
+        members written, as for :func:`make_zipfile`, and the seconds taken.
+        """
+        return self.pool.apply(_timed, (make_zipfile, output_filename, source_dir, compression))
+
+    def zip_file(self, output_filename, filename, arcname, compression=zipfile.ZIP_DEFLATED):
+        """
+        Write *filename* to *output_filename*, returning the seconds taken.
+        """
+        return self.pool.apply(_timed, (zip_file, output_filename, filename, arcname, compression))[1]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def extract_changed(filename, os_path):
+    """
+    Extract the archive *filename* into the working tree *os_path*.
+
+    If the tree was written to this archive by :meth:`File.writezip` and
+    the archive hasn't changed since, the tree is used as is.  Otherwise
+    only the members whose CRC or size differ from what was last written
+    from the tree are extracted.  Files in the tree which are newer than
+    the archive are kept.
+    """
+    record = _WORKING_TREES.get(os.path.abspath(os_path), None)
+    if record is not None and record[0] != os.path.abspath(filename):
+        record = None
+    if record is not None and os.path.isdir(os_path):
+        st = os.stat(filename)
+        if (record[1], record[2]) == (st.st_size, st.st_mtime):
+            return
+    members = record[3] if record is not None else {}
+    archive_mtime = os.stat(filename).st_mtime
+    zf = zipfile.ZipFile(filename)
+    try:
+        for info in zf.infolist():
+            target = os.path.join(os_path, info.filename)
+            if info.filename.endswith('/'):
+                if os.path.isdir(target): continue
+            elif os.path.isfile(target):
+                if members.get(info.filename, None) == (info.CRC, info.file_size) \
+                        and os.path.getsize(target) == info.file_size:
+                    continue
+                if os.path.getmtime(target) > archive_mtime:
+                    continue
+            zf.extract(info, os_path)
+    finally:
+        zf.close()
                             
 
 #compatibility with h5nexus:
@@ -0,0 +1,142 @@
+"""
+Asyncio interface to read-only NeXus zip files.
+
+Reading a member of an archive blocks on file I/O, decompression and
+parsing, so the reads are run on a bounded pool of threads and awaited::
+
+    f = await hzf_async.File("scan.nxz", workers=4)
+    counts = await f.aget('entry/DAS_logs/counter/liveMonitor')
+    das = await f.aget('entry/DAS_logs')
+    async for name, node in das.aitems():
+        ...
+    await f.close()
+
+Fields are returned as their values, and groups as :class:`AsyncGroup`.
+Concurrent requests for the same path share a single read.  Cancelling a
+request cancels the read once no other request is waiting on it, though
+a read which has already started on a worker thread runs to completion.
+
+Requires Python 3.6 or later.
+"""
+import asyncio
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+import hzf_readonly
+
+async def File(filename, workers=4, **kw):
+    """
+    Open *filename* with :func:`hzf_readonly.File`, reading it on a pool of
+    *workers* threads.  Keyword arguments are passed to hzf_readonly.File.
+    """
+    executor = ThreadPoolExecutor(workers)
+    loop = asyncio.get_event_loop()
+    try:
+        f = await loop.run_in_executor(executor, lambda: hzf_readonly.File(filename, **kw))
+    except BaseException:
+        executor.shutdown(wait=False)
+        raise
+    return AsyncFile(f, executor)
+
+class AsyncGroup(object):
+    """
+    Group of an :class:`AsyncFile`.  *node* is the underlying hzf_readonly
+    group, table or record.
+    """
+    def __init__(self, file, node):
+        self.file = file
+        self.node = node
+        self.path = node.path
+        self.attrs = node.attrs
+
+    @property
+    def name(self):
+        return self.path
+
+    def __repr__(self):
+        return "<async %r>" % (self.node,)
+
+    async def aget(self, path):
+        """
+        Return the value of the field or the group at *path*, relative to
+        this group unless it starts with '/'.
+        """
+        return await self.file.aget(posixpath.join(self.path, path))
+
+    async def akeys(self):
+        """
+        Return the names of the members of the group.
+        """
+        return await self.file._run(self.node.keys)
+
+    async def aitems(self):
+        """
+        Yield (name, node) for each member of the group, in order.  All of
+        the members are requested at once, so they are read concurrently
+        while earlier ones are being consumed.
+        """
+        keys = await self.akeys()
+        loop = asyncio.get_event_loop()
+        tasks = [loop.create_task(self.aget(key)) for key in keys]
+        try:
+            for key, task in zip(keys, tasks):
+                yield key, await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+class AsyncFile(AsyncGroup):
+    """
+    Read-only file whose reads are run on *executor*.  Use :func:`File` to
+    open one.
+    """
+    def __init__(self, file, executor):
+        self.executor = executor
+        # reads in progress: path -> [future, number of waiters]
+        self._pending = {}
+        AsyncGroup.__init__(self, self, file)
+
+    async def aget(self, path):
+        path = posixpath.join(self.path, path)
+        pending = self._pending.get(path, None)
+        if pending is None:
+            future = asyncio.ensure_future(self._run(self._read, path))
+            pending = self._pending[path] = [future, 0]
+            def done(_future, pending=pending):
+                if self._pending.get(path, None) is pending:
+                    del self._pending[path]
+            future.add_done_callback(done)
+        pending[1] += 1
+        try:
+            return await asyncio.shield(pending[0])
+        finally:
+            pending[1] -= 1
+            if pending[1] == 0 and not pending[0].done():
+                pending[0].cancel()
+
+    def _read(self, path):
+        node = self.node[path]
+        if isinstance(node, (hzf_readonly.FieldFile, hzf_readonly.RecordField)):
+            return node.value
+        return AsyncGroup(self, node)
+
+    def _run(self, fn, *args):
+        return asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+
+    async def close(self):
+        """
+        Cancel the outstanding reads and close the file.
+        """
+        for future, _ in list(self._pending.values()):
+            future.cancel()
+        self._pending = {}
+        try:
+            await self._run(self.node.close)
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -1,5 +1,8 @@
 import os, sys
 import zipfile, tempfile, shutil
+import itertools
+import hashlib, struct, zlib, io, mmap
+import threading, collections
 from json_backed_dict import JSONBackedDict
 import numpy, json
 import iso8601
@@ -12,7 +15,10 @@ else:
 DEFAULT_ENDIANNESS = '<' if (sys.byteorder == 'little') else '>'
 __version__ = "0.0.1"
 
-import __builtin__
+try:
+    import __builtin__
+except ImportError:
+    import builtins as __builtin__
 
 class Node(object):
     _attrs_filename = ".attrs"
@@ -85,20 +91,45 @@ class Node(object):
             full_path = os.path.join(self.path, path)
 
         #os_path = os.path.join(self.os_path, full_path.lstrip("/"))
-        if self.root.exists(full_path):
+        if self.root._exists(full_path):
             #print os_path, full_path
             if self.root.isdir(full_path):
                 # it's a group
-                return Group(self, full_path)
-            elif self.root.exists(full_path + ".link"):
+                group = Group(self, full_path)
+                if 'record_class' in group.attrs:
+                    # it's a table of records
+                    return RecordTable(self, full_path)
+                return group
+            elif self.root._exists(full_path + ".link"):
                 # it's a link
                 return FieldLink(self, full_path)
             else:
                 # it's a field
                 return FieldFile(self, full_path)
         else:
-            # the item doesn't exist
-            raise KeyError(path)
+            item = self.root._find_record(full_path)
+            if item is None:
+                # the item doesn't exist
+                raise KeyError(path)
+            return item
+
+    def _find_record(self, full_path):
+        """
+        Return the record or record field at *full_path* if the path is
+        within a table of records, or None.
+        """
+        table_path = os.path.dirname(full_path.rstrip("/"))
+        while table_path not in ("", "/"):
+            if self.root.isdir(table_path):
+                table = self.root[table_path]
+                if isinstance(table, RecordTable):
+                    try:
+                        return table[os.path.relpath(full_path, table_path)]
+                    except KeyError:
+                        return None
+                return None
+            table_path = os.path.dirname(table_path)
+        return None
     
     def add_field(self, path, **kw):
         FieldFile(self, path, **kw)
@@ -112,6 +143,17 @@ class ReadOnlyNode(Node):
     def makeAttrs(self):
         return json.loads(self.root.open(os.path.join(self.path, self._attrs_filename), "r").read())
         
+def _is_archive_data(source):
+    """
+    True if *source* is the contents of an archive or a file object rather
+    than a filename.
+    """
+    if isinstance(source, bytes):
+        # bytes is str in python 2, so check for a zip signature
+        return source[:4] in (b'PK\x03\x04', b'PK\x05\x06')
+    return (isinstance(source, (bytearray, memoryview, mmap.mmap))
+            or hasattr(source, 'read'))
+
 def File(*args, **kw):
     mode = kw.get("mode", "r")
     if (mode == "r"):
@@ -121,19 +163,31 @@ def File(*args, **kw):
         
 
 class FileRW(Node):
-    def __init__(self, filename, mode="r", timestamp=None, creator=None, compression=zipfile.ZIP_DEFLATED, attrs={}, os_path=None, **kw):
+    def __init__(self, filename, mode="r", timestamp=None, creator=None, compression=zipfile.ZIP_DEFLATED, attrs={}, os_path=None, cache_dir=None, cache_attrs=False, archive=None, **kw):
         self.readonly = (mode == "r")
         Node.__init__(self, parent_node=None, path="/")
+        # archive shared with other files, e.g., from an ArchivePool
+        self.shared = archive is not None
         if self.readonly:
-            self.zipfile = zipfile.ZipFile(filename) 
+            if archive is not None:
+                self.zipfile = archive
+            elif _is_archive_data(filename):
+                self.zipfile = StreamArchive(filename)
+                filename = self.zipfile.filename
+            else:
+                self.zipfile = CachedArchive.load(filename, cache_dir, cache_attrs)
+        # field values decoded by prefetch, keyed by path
+        self.values = {}
+        self.prefetch_pool = None
+        self.closing = False
         self.attrs = self.makeAttrs()
         self.filename = filename
         self.mode = mode
         self.compression = compression
-        file_exists = os.path.exists(filename)
         
        
         if not self.readonly:
+            file_exists = os.path.exists(filename)
             if os_path is None:
                 fn = tempfile.mkdtemp()
                 self.os_path = fn
@@ -173,8 +227,7 @@ class FileRW(Node):
             if path == "": 
                 return True # root path
             else:
-                filenames = self.root.zipfile.namelist()
-                return ((path.rstrip("/") + "/") in filenames)
+                return (path.rstrip("/") + "/") in self.root.zipfile
         else:
             return os.path.isdir(os.path.join(self.os_path, path))
             
@@ -183,17 +236,21 @@ class FileRW(Node):
         should work for unpacked directories and packed zip archives """
         path = path.strip("/")
         if self.readonly:
-            return [os.path.basename(fn.rstrip("/")) for fn in self.zipfile.namelist() if os.path.dirname(fn.rstrip("/")) == path]
+            return self.zipfile.listdir(path)
         else:
             return os.path.listdir(os.path.join(self.os_path, path))
             
     def exists(self, path):
         """ abstraction for looking up paths: 
-        should work for unpacked directories and packed zip archives """
+        should work for unpacked directories and packed zip archives.
+        Rows of record tables and their fields exist as well. """
+        return self._exists(path) or self._find_record("/" + path.strip("/")) is not None
+
+    def _exists(self, path):
+        """ True if *path* is stored in the archive or the tree """
         path = path.strip("/")
         if self.readonly:
-            filenames = self.root.zipfile.namelist()
-            return (path in filenames or self.isdir(path))
+            return (path in self.root.zipfile or self.isdir(path))
         else:
             return os.path.exists(os.path.join(self.os_path, path))
     
@@ -216,11 +273,49 @@ class FileRW(Node):
                 
     def __repr__(self):
         return "<HDZIP file \"%s\" (mode %s)>" % (self.filename, self.mode)
-           
+
+    def prefetch(self, paths, workers=4):
+        """
+        Read and decode the fields in *paths* using *workers* threads,
+        keeping the values in memory so that later reads of the fields
+        don't go back to the archive.
+
+        Returns immediately with the result of the thread pool map, whose
+        get() method waits for the fields to be read and raises the first
+        error encountered.  Reading a field before it has been prefetched
+        reads it from the archive as usual.
+
+        The threads are started by the first call and kept until the file
+        is closed, so *workers* only applies to the first call.  Closing
+        the file cancels the reads which haven't started.
+        """
+        if not self.readonly:
+            raise RuntimeError("can't prefetch in write mode")
+        from multiprocessing.pool import ThreadPool
+        def fetch(path):
+            if self.closing:
+                raise RuntimeError("file closed before %s was prefetched" % path)
+            field = self[path]
+            self.values[field.path] = field._read_value()
+            return field.path
+        if self.prefetch_pool is None:
+            self.prefetch_pool = ThreadPool(max(1, workers))
+        return self.prefetch_pool.map_async(fetch, list(paths))
+
     def close(self):
         # there seems to be only one read-only mode
         if self.readonly:
-            self.zipfile.close()
+            if self.prefetch_pool is not None:
+                # wait for the reads in progress so that none of them fills
+                # the cache after it is cleared
+                self.closing = True
+                self.prefetch_pool.close()
+                self.prefetch_pool.join()
+                self.prefetch_pool = None
+                self.closing = False
+            self.values = {}
+            if not self.shared:
+                self.zipfile.close()
         else:
             if os.path.exists(self.os_path):
                 self.writezip()
@@ -230,6 +325,437 @@ class FileRW(Node):
         make_zipfile(self.filename, os.path.join(self.os_path, self.path.lstrip("/")), self.compression)
         
     
+class CachedArchive(object):
+    """
+    Zip archive opened from a saved copy of its member table.
+
+    Parsing the central directory of an archive with many members takes
+    a while, so the member table (name, offset, sizes, CRC and compression
+    of each member) is saved to a cache file in *cache_dir* the first time
+    the archive is opened, and is used instead while the archive size and
+    modification time are unchanged.  If *cache_attrs* is set, the text of
+    the .attrs members is saved as well, so walking the tree doesn't need
+    to touch the archive at all.
+
+    Members are read from their offsets in the archive, so the archive
+    itself is never parsed.  Reads are safe from any number of threads:
+    the raw bytes are read with os.pread where available, or under a lock
+    otherwise, and decompressed outside of the lock.  Only the parts of the
+    ZipFile interface used by :class:`FileRW` are provided.
+    """
+    def __init__(self, filename, infolist, attrs=None):
+        self.filename = filename
+        self.infos = dict((info.filename, info) for info in infolist)
+        self.names = [info.filename for info in infolist]
+        self.attrs = attrs if attrs is not None else {}
+        self.children = None
+        self.fp = None
+        self.read_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, filename, cache_dir=None, cache_attrs=False):
+        """
+        Open *filename* using the member table saved in *cache_dir*,
+        parsing and saving it if needed.  Without a *cache_dir*, the
+        archive is parsed and nothing is saved.
+        """
+        st = os.stat(filename)
+        if cache_dir is not None:
+            cache = os.path.join(cache_dir, hashlib.sha1(_b(os.path.abspath(filename))).hexdigest() + ".json")
+            try:
+                with __builtin__.open(cache) as fd:
+                    saved = json.load(fd)
+                if saved['size'] == st.st_size and saved['mtime'] == st.st_mtime:
+                    return cls(filename, [_zipinfo(*m) for m in saved['members']],
+                               saved.get('attrs', None))
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        zf = zipfile.ZipFile(filename)
+        try:
+            infolist = zf.infolist()
+            attrs = None
+            if cache_attrs:
+                attrs = dict((info.filename, zf.read(info.filename).decode('utf-8'))
+                             for info in infolist if info.filename.endswith('.attrs'))
+        finally:
+            zf.close()
+        if cache_dir is None:
+            return cls(filename, infolist, attrs)
+        saved = {
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'members': [(info.filename, info.header_offset, info.compress_size,
+                         info.file_size, info.CRC, info.compress_type)
+                        for info in infolist],
+            }
+        if attrs is not None:
+            saved['attrs'] = attrs
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "w") as outfile:
+            json.dump(saved, outfile)
+        os.rename(tmp, cache)
+        return cls(filename, infolist, attrs)
+
+    def namelist(self):
+        return list(self.names)
+
+    def infolist(self):
+        return [self.infos[name] for name in self.names]
+
+    def getinfo(self, name):
+        return self.infos[name]
+
+    def __contains__(self, name):
+        return name in self.infos
+
+    def listdir(self, path):
+        """
+        Names of the members directly below the directory *path*, in
+        archive order.  The directory index is built on the first call.
+        """
+        if self.children is None:
+            children = {}
+            for name in self.names:
+                name = name.rstrip("/")
+                children.setdefault(os.path.dirname(name), []).append(os.path.basename(name))
+            self.children = children
+        return list(self.children.get(path, []))
+
+    def read(self, name):
+        if name in self.attrs:
+            return self.attrs[name].encode('utf-8')
+        info = self.infos[name]
+        if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return self._read_other(name)
+        data = self._read_at(self._data_offset(info), info.compress_size)
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompressobj(-15).decompress(data)
+        if zlib.crc32(data) & 0xffffffff != info.CRC:
+            raise zipfile.BadZipfile("Bad CRC-32 for file %r" % name)
+        return data
+
+    def open(self, name, mode="r"):
+        """
+        Return a file object for member *name*.  Stored and deflated
+        members are read from the archive in chunks as the file is read,
+        so reading part of a member only reads and decompresses that part.
+        """
+        info = self.infos[name]
+        if (name in self.attrs or name.endswith('.attrs')
+                or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)):
+            return io.BytesIO(self.read(name))
+        return io.BufferedReader(_MemberFile(self, info, self._data_offset(info)))
+
+    def _data_offset(self, info):
+        """
+        Offset of the data of the member *info*, following its local header.
+        """
+        header = struct.unpack(zipfile.structFileHeader,
+                               self._read_at(info.header_offset, zipfile.sizeFileHeader))
+        return (info.header_offset + zipfile.sizeFileHeader
+                + header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+    def _read_other(self, name):
+        """
+        Read a member compressed with a method other than stored or deflated.
+        """
+        zf = zipfile.ZipFile(self.filename)
+        try:
+            return zf.read(name)
+        finally:
+            zf.close()
+
+    def _read_at(self, offset, size):
+        """
+        Read *size* bytes at *offset* in the archive.
+        """
+        if hasattr(os, 'pread'):
+            fd = self._fp().fileno()
+            chunks = []
+            while size > 0:
+                chunk = os.pread(fd, size, offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+                size -= len(chunk)
+            return b''.join(chunks)
+        fp = self._fp()
+        with self.read_lock:
+            fp.seek(offset)
+            return fp.read(size)
+
+    def _fp(self):
+        if self.fp is None:
+            with self.read_lock:
+                if self.fp is None:
+                    self.fp = __builtin__.open(self.filename, "rb")
+        return self.fp
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+class _MemberFile(io.RawIOBase):
+    """
+    Raw stream of a stored or deflated member of a :class:`CachedArchive`,
+    starting at *offset* in the archive.  The member is read in chunks and
+    decompressed as needed, with the CRC checked at the end.
+    """
+    chunk_size = 1<<16
+
+    def __init__(self, archive, info, offset):
+        io.RawIOBase.__init__(self)
+        self.archive = archive
+        self.info = info
+        self.offset = offset
+        self.remaining = info.compress_size
+        self.decompressor = (zlib.decompressobj(-15)
+                             if info.compress_type == zipfile.ZIP_DEFLATED else None)
+        self.crc = 0
+        self.pending, self.pos = b'', 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.pos == len(self.pending) and not self.eof:
+            self._fill()
+        data = self.pending[self.pos:self.pos+len(b)]
+        self.pos += len(data)
+        b[:len(data)] = data
+        return len(data)
+
+    def _fill(self):
+        size = min(self.remaining, self.chunk_size)
+        raw = self.archive._read_at(self.offset, size) if size else b''
+        if len(raw) < size:
+            raise zipfile.BadZipfile("Truncated file %r" % self.info.filename)
+        self.offset += size
+        self.remaining -= size
+        if self.decompressor is None:
+            data = raw
+        else:
+            data = self.decompressor.decompress(raw)
+            if not self.remaining:
+                data += self.decompressor.flush()
+        self.crc = zlib.crc32(data, self.crc)
+        self.pending, self.pos = data, 0
+        if not self.remaining:
+            self.eof = True
+            if self.crc & 0xffffffff != self.info.CRC:
+                raise zipfile.BadZipfile("Bad CRC-32 for file %r" % self.info.filename)
+
+class StreamArchive(CachedArchive):
+    """
+    Zip archive held in memory or in an open file.
+
+    *source* is either a buffer (bytes, bytearray, memoryview or mmap)
+    holding the archive, in which case members are read by slicing the
+    buffer, or a seekable file object, which is read under a lock.  The
+    source is not closed when the archive is closed.
+    """
+    def __init__(self, source):
+        name = getattr(source, 'name', None) or "<%s>" % type(source).__name__
+        if hasattr(source, 'read') and not isinstance(source, mmap.mmap):
+            self.buffer, self.stream = None, source
+        else:
+            if isinstance(source, bytearray):
+                source = memoryview(source)
+            if isinstance(source, memoryview) and source.itemsize != 1:
+                # memoryview.cast is new in Python 3.3
+                if not hasattr(source, 'cast'):
+                    raise TypeError("memoryview of %d byte items; use a view of bytes"
+                                    % source.itemsize)
+                source = source.cast('B')
+            self.buffer, self.stream = source, None
+        zf = zipfile.ZipFile(self._file())
+        try:
+            infolist = zf.infolist()
+        finally:
+            zf.close()
+        CachedArchive.__init__(self, name, infolist)
+
+    def _file(self):
+        return _BufferFile(self) if self.buffer is not None else self.stream
+
+    def _read_at(self, offset, size):
+        if self.buffer is not None:
+            data = self.buffer[offset:offset+size]
+            return data.tobytes() if isinstance(data, memoryview) else data
+        with self.read_lock:
+            self.stream.seek(offset)
+            return self.stream.read(size)
+
+    def _read_other(self, name):
+        with self.read_lock:
+            zf = zipfile.ZipFile(self._file())
+            try:
+                return zf.read(name)
+            finally:
+                zf.close()
+
+    def close(self):
+        self.buffer = self.stream = None
+
+class _BufferFile(object):
+    """
+    Read-only file interface to the buffer of a :class:`StreamArchive`,
+    for zipfile to parse.
+    """
+    def __init__(self, archive):
+        self.archive = archive
+        self.size = len(archive.buffer)
+        self.pos = 0
+
+    def seek(self, offset, whence=0):
+        self.pos = offset + (0, self.pos, self.size)[whence]
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.pos
+        data = self.archive._read_at(self.pos, size)
+        self.pos += len(data)
+        return data
+
+class SharedArchive(CachedArchive):
+    """
+    Archive which can be read from several threads at once.
+
+    Each thread reads members through its own file descriptor.  The text
+    of the .attrs members is kept once read, so views of the archive
+    share the attrs tree.  A descriptor is closed when its thread exits.
+    Once the archive is closed, the descriptors are closed as soon as no
+    thread is reading, and are only opened for the duration of a read
+    after that.
+    """
+    def __init__(self, filename, infolist, attrs=None):
+        CachedArchive.__init__(self, filename, infolist, attrs)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.fps = set()
+        self.readers = 0
+        self.closed = False
+
+    def read(self, name):
+        if name in self.attrs:
+            return self.attrs[name].encode('utf-8')
+        data = CachedArchive.read(self, name)
+        if name.endswith('.attrs'):
+            self.attrs[name] = data.decode('utf-8')
+        return data
+
+    def _read_at(self, offset, size):
+        with self.lock:
+            self.readers += 1
+        try:
+            fp = self._fp()
+            fp.seek(offset)
+            return fp.read(size)
+        finally:
+            with self.lock:
+                self.readers -= 1
+                if self.closed and not self.readers:
+                    self._close_fps()
+
+    def _fp(self):
+        handle = getattr(self.local, 'handle', None)
+        if handle is None:
+            fp = __builtin__.open(self.filename, "rb")
+            with self.lock:
+                self.fps.add(fp)
+            handle = self.local.handle = _ThreadFile(fp, self.fps)
+        return handle.fp
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if not self.readers:
+                self._close_fps()
+
+    def _close_fps(self):
+        # called with the lock held
+        for fp in list(self.fps):
+            fp.close()
+        self.fps.clear()
+        self.local = threading.local()
+
+class _ThreadFile(object):
+    """
+    File descriptor of one thread reading a :class:`SharedArchive`, held
+    in the thread-local storage of the archive so that it is closed and
+    dropped from the open descriptors *fps* when the thread exits.
+    """
+    def __init__(self, fp, fps):
+        self.fp = fp
+        self.fps = fps
+
+    def __del__(self):
+        # may run while another thread holds the archive lock, so don't
+        # take it; removing from a set is atomic
+        self.fps.discard(self.fp)
+        self.fp.close()
+
+class ArchivePool(object):
+    """
+    Open archives shared by the whole process.
+
+    :meth:`open` returns a read-only :class:`FileRW` view of the archive,
+    parsing the archive only if it isn't already in the pool or if its
+    size or modification time have changed.  Views are cheap and may be
+    used from any thread; closing a view leaves the archive open.  At
+    most *max_open* archives are kept, with the least recently used
+    archive closed to make room.  A view of an archive which has been
+    closed reopens it on the next read.  The member tables are saved in
+    *cache_dir* if it is given, as for :class:`CachedArchive`.
+    """
+    def __init__(self, max_open=64, cache_dir=None, cache_attrs=False):
+        self.max_open = max_open
+        self.cache_dir = cache_dir
+        self.cache_attrs = cache_attrs
+        self.archives = collections.OrderedDict() # path: (size, mtime, archive)
+        self.lock = threading.Lock()
+
+    def open(self, filename):
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        with self.lock:
+            item = self.archives.pop(path, None)
+            if item is not None and item[:2] != (st.st_size, st.st_mtime):
+                item[2].close()
+                item = None
+            if item is None:
+                archive = SharedArchive.load(path, self.cache_dir, self.cache_attrs)
+                item = (st.st_size, st.st_mtime, archive)
+            self.archives[path] = item
+            while len(self.archives) > self.max_open:
+                _, (_, _, oldest) = self.archives.popitem(last=False)
+                oldest.close()
+        return FileRW(filename, archive=item[2])
+
+    def close(self):
+        with self.lock:
+            items, self.archives = list(self.archives.values()), collections.OrderedDict()
+        for _, _, archive in items:
+            archive.close()
+
+def _zipinfo(name, header_offset, compress_size, file_size, CRC, compress_type):
+    info = zipfile.ZipInfo(name)
+    info.header_offset = header_offset
+    info.compress_size = compress_size
+    info.file_size = file_size
+    info.CRC = CRC
+    info.compress_type = compress_type
+    return info
+
 class Group(Node):
     def __init__(self, node, path, nxclass="NXCollection", attrs={}):
         Node.__init__(self, parent_node=node, path=path)
@@ -257,6 +783,129 @@ class Group(Node):
     def __repr__(self):
         return "<HDZIP group \"" + self.path + "\">"
     
+class RecordTable(Group):
+    """
+    Compatibility view of a table of records.
+
+    The data writer can store notes and error logs as one table with a row
+    per record, with the record names in the *name* column.  The view
+    presents each row as a group of single valued fields, as if it had been
+    written as a separate group of class *record_class*, so that
+    'notes/note2/data' can still be looked up.
+    """
+    def __init__(self, node, path):
+        Group.__init__(self, node, path)
+        self._columns = {}
+        
+    def column(self, name):
+        if name not in self._columns:
+            self._columns[name] = FieldFile(self, name)
+        return self._columns[name]
+        
+    @property
+    def columns(self):
+        return [k for k in Node.keys(self) if k != 'name']
+        
+    def _values(self, name):
+        field = self.column(name)
+        if not hasattr(field, '_value'):
+            field._value = field.value
+        return field._value
+        
+    def keys(self):
+        return [n.decode('utf-8') if isinstance(n, bytes) else n
+                for n in self._values('name')]
+        
+    def __contains__(self, key):
+        name, _, rest = key.strip("/").partition("/")
+        if name not in self.keys():
+            return False
+        return not rest or rest in self.columns
+        
+    def __getitem__(self, path):
+        name, _, rest = path.strip("/").partition("/")
+        try:
+            row = self.keys().index(name)
+        except ValueError:
+            raise KeyError(path)
+        record = Record(self, name, row)
+        return record[rest] if rest else record
+        
+class Record(object):
+    """
+    One row of a :class:`RecordTable`, presented as a group.
+    """
+    def __init__(self, table, name, row):
+        self.table = table
+        self.row = row
+        self.root = table.root
+        self.path = os.path.join(table.path, name)
+        self.attrs = {'NX_class': table.attrs['record_class']}
+        
+    @property
+    def name(self):
+        return self.path
+        
+    @property
+    def parent(self):
+        return self.table
+        
+    def keys(self):
+        return self.table.columns
+        
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+        
+    def __contains__(self, key):
+        return key in self.keys()
+        
+    def __getitem__(self, key):
+        if key not in self.keys():
+            raise KeyError(key)
+        return RecordField(self, key)
+        
+    def __repr__(self):
+        return "<HDZIP record \"" + self.path + "\">"
+        
+class RecordField(object):
+    """
+    One cell of a :class:`RecordTable`, presented as a field of length 1.
+    """
+    def __init__(self, record, column):
+        self.record = record
+        self.root = record.root
+        self.path = os.path.join(record.path, column)
+        field = record.table.column(column)
+        self.attrs = dict(field.attrs, shape=[1])
+        self._column = column
+        
+    @property
+    def value(self):
+        values = self.record.table._values(self._column)
+        return values[self.record.row:self.record.row+1]
+        
+    def __getitem__(self, slice_def):
+        return self.value.__getitem__(slice_def)
+        
+    @property
+    def shape(self):
+        return self.attrs['shape']
+        
+    @property
+    def dtype(self):
+        return self.attrs.get('dtype', None)
+        
+    @property
+    def name(self):
+        return self.path
+        
+    @property
+    def parent(self):
+        return self.record
+        
+    def __repr__(self):
+        return "<HDZIP field \"%s\" %s \"%s\">" % (self.name, str(self.shape), self.dtype)
+    
 
 class FieldFile(object):
     _formats = {
@@ -361,7 +1010,7 @@ class FieldFile(object):
             path = os.path.join(node.path, path)
         self.path = path
             
-        preexisting = self.root.exists(self.path)
+        preexisting = self.root._exists(self.path)
             
         self.attrs_path = self.path + self._attrs_suffix
         self.attrs = self.makeAttrs()
@@ -427,26 +1076,67 @@ class FieldFile(object):
                 
     @property
     def value(self):
+        if self.root.readonly:
+            d = self.root.values.get(self.path, None)
+            if d is not None:
+                return d.copy()
+        return self._read_value()
+
+    def _read_value(self):
         attrs = self.attrs
         target = self.path
         with self.root.open(target, 'rb') as infile:
             if attrs.get('binary', False) == True:
-                d = numpy.fromfile(infile, dtype=attrs['format'])
+                d = numpy.frombuffer(bytearray(infile.read()), dtype=_field_dtype(attrs))
             else:
-                if self.root.getsize(target) == 1:
+                dtype = _field_dtype(attrs)
+                if dtype.kind == 'S' and len(attrs.get('shape', [])) <= 1:
+                    # one string per line; strings may be empty or contain
+                    # spaces, so don't let loadtxt split them.
+                    lines = infile.read().split(b'\n')
+                    if lines and lines[-1] == b'': lines.pop()
+                    d = numpy.array(lines, dtype=dtype)
+                elif self.root.getsize(target) == 1:
                     # empty entry: only contains \n
                     # this is only possible with empty string being written.
-                    d = numpy.array([''], dtype=numpy.dtype(str(attrs['format'])))
+                    d = numpy.array([''], dtype=dtype)
                 else:
-                    d = numpy.loadtxt(infile, dtype=numpy.dtype(str(attrs['format'])))
+                    d = numpy.loadtxt(infile, dtype=dtype)
         if 'shape' in attrs:
             d = d.reshape(attrs['shape'])
         return d              
     
+    def read_rows(self, start, stop):
+        """
+        Return rows *start* to *stop* of the field, reading only as far
+        into the stored data as needed.
+        """
+        attrs = self.attrs
+        shape = list(attrs['shape'])
+        stop = min(stop, shape[0])
+        start = min(start, stop)
+        dtype = _field_dtype(attrs)
+        with self.root.open(self.path, 'rb') as infile:
+            if attrs.get('binary', False) == True:
+                rowsize = dtype.itemsize*int(numpy.prod(shape[1:]))
+                skip = start*rowsize
+                while skip > 0:
+                    skip -= len(infile.read(min(skip, 1<<20)))
+                d = numpy.frombuffer(bytearray(infile.read((stop-start)*rowsize)), dtype=dtype)
+            else:
+                lines = list(itertools.islice(infile, start, stop))
+                if dtype.kind == 'S' and len(shape) <= 1:
+                    d = numpy.array([line.rstrip(b'\n') for line in lines], dtype=dtype)
+                elif lines:
+                    d = numpy.loadtxt(lines, dtype=dtype)
+                else:
+                    d = numpy.empty(0, dtype=dtype)
+        return d.reshape([stop-start] + shape[1:])
+
     @value.setter
     def value(self, data):
         if self.root.readonly:
-            raise StandardError("can't set value in readonly mode")
+            raise RuntimeError("can't set value in readonly mode")
             return
         attrs = self.attrs
         if hasattr(data, 'shape'): attrs['shape'] = data.shape
@@ -471,7 +1161,7 @@ class FieldFile(object):
                 
     def append(self, data, coerce_dtype=True):
         if self.root.readonly:
-            raise StandardError("can't append in readonly mode")
+            raise RuntimeError("can't append in readonly mode")
             return 
         # add to the data...
         # can only append along the first axis, e.g. if shape is (3,4)
@@ -492,7 +1182,7 @@ class FieldFile(object):
         
     def extend(self, data, coerce_dtype=True):
         if self.root.readonly:
-            raise StandardError("can't extend in readonly mode")
+            raise RuntimeError("can't extend in readonly mode")
             return 
         attrs = self.attrs
         if (list(data.shape[1:]) != list(attrs.get('shape', [])[1:])):
@@ -503,6 +1193,12 @@ class FieldFile(object):
         #    else:
         #        data = data.astype(attrs['dtype'])
                 
+        if data.dtype.kind == 'S' and 'format' in attrs:
+            # widen the stored string format so that longer strings
+            # are not truncated on read
+            if data.dtype.itemsize > numpy.dtype(str(attrs['format'])).itemsize:
+                attrs['format'] = attrs['format'][0] + "S%d" % (data.dtype.itemsize,)
+                
         new_shape = list(attrs['shape'])
         new_shape[0] += data.shape[0]
         attrs['shape'] = new_shape
@@ -523,7 +1219,7 @@ class FieldLink(FieldFile):
         
         self.target = target_path
         FieldFile.__init__(self, node, target_path, **kw)
-        preexisting = self.root.exists(self.orig_path)
+        preexisting = self.root._exists(self.orig_path)
         if preexisting:
             pass
         else:
@@ -538,8 +1234,12 @@ class FieldLink(FieldFile):
         
 import collections
 from itertools import chain
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
-class StaticDictWrapper(collections.MutableMapping):
+class StaticDictWrapper(MutableMapping):
     def __init__(self, wrapped_dict, static_dict):
         self.wrapped_dict = wrapped_dict
         self.static_dict = static_dict
@@ -578,7 +1278,7 @@ class StaticDictWrapper(collections.MutableMapping):
         return len(self.static_dict) + len(self.wrapped_dict)
             
 
-def write_item(zipOut, relroot, root, permissions=0755):
+def write_item(zipOut, relroot, root, permissions=0o755):
     """ check if a path points to a link, or a file, or a directory,
     and take appropriate action in the zip archive """
     # zipinfo.external_attr = 0644 << 16L # permissions -r-wr--r--
@@ -592,8 +1292,8 @@ def write_item(zipOut, relroot, root, permissions=0755):
         zipInfo.create_system = 3
         # long type of hex val of '0xA1ED0000L',
         # say, symlink attr magic...
-        zipInfo.external_attr = permissions << 16L       
-        zipInfo.external_attr |= 0120000 << 16L # symlink file type        
+        zipInfo.external_attr = permissions << 16
+        zipInfo.external_attr |= 0o120000 << 16 # symlink file type        
         zipOut.writestr(zipInfo, os.readlink(root))
         return
     else:
@@ -655,6 +1355,127 @@ def extend(node, data):
 def append(node, data):
     node.append(data)
     
+def _field_dtype(attrs):
+    """
+    Type of the stored data.  The format is the byte order, type character
+    and size, which isn't a valid type for some types (e.g., '<d8'), so
+    fall back to the type name with the byte order of the format.
+    """
+    try:
+        return numpy.dtype(str(attrs['format']))
+    except TypeError:
+        return numpy.dtype(str(attrs['dtype'])).newbyteorder(str(attrs['format'][0]))
+
+class VirtualField(object):
+    """
+    Field *path* from each file in *filenames*, joined along the first axis.
+
+    Only the attrs of the fields are read when the virtual field is
+    created.  Indexing the first axis reads just the rows needed from the
+    files which hold them, into an array allocated once for the result.
+    Use *value* for the whole field.  Call :meth:`close` when done.
+
+    The files are opened through the :class:`ArchivePool` *pool* as they
+    are read, so no more than its *max_open* files are held open at once.
+    By default the virtual field has a pool of its own.
+    """
+    def __init__(self, filenames, path, pool=None):
+        self.path = path
+        self.filenames = list(filenames)
+        self.own_pool = pool is None
+        self.pool = ArchivePool(max_open=16) if pool is None else pool
+        try:
+            attrs = [self.pool.open(filename)[path].attrs for filename in self.filenames]
+        except:
+            self.close()
+            raise
+        shapes = [list(a['shape']) for a in attrs]
+        rowshape = shapes[0][1:] if shapes else []
+        for filename,shape in zip(self.filenames, shapes):
+            if shape[1:] != rowshape:
+                self.close()
+                raise ValueError("%s in %s has rows of shape %s, not %s"
+                                 % (path, filename, shape[1:], rowshape))
+        dtypes = [_field_dtype(a) for a in attrs]
+        self.dtype = dtypes[0] if dtypes else numpy.dtype('float64')
+        for dtype in dtypes[1:]:
+            self.dtype = numpy.promote_types(self.dtype, dtype)
+        self.offsets = numpy.cumsum([0] + [shape[0] for shape in shapes])
+        self.shape = tuple([int(self.offsets[-1])] + rowshape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "<HDZIP virtual field \"%s\" %s from %d files>" % (self.path, str(self.shape), len(self.filenames))
+
+    @property
+    def value(self):
+        return self[:]
+
+    def __getitem__(self, index):
+        rest = ()
+        if isinstance(index, tuple):
+            index, rest = index[0], index[1:]
+        rows = numpy.arange(self.shape[0])[index]
+        if numpy.ndim(rows) == 0:
+            return self[rows:rows+1][(0,)+rest]
+        result = numpy.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        if len(rows):
+            for k,filename in enumerate(self.filenames):
+                lo, hi = self.offsets[k], self.offsets[k+1]
+                mask = (rows >= lo) & (rows < hi)
+                if not mask.any():
+                    continue
+                local = rows[mask] - lo
+                first = local.min()
+                field = self.pool.open(filename)[self.path]
+                result[mask] = field.read_rows(first, local.max()+1)[local-first]
+        return result[(slice(None),)+rest] if rest else result
+
+    def close(self):
+        if self.own_pool:
+            self.pool.close()
+
+def _read_file_fields(args):
+    filename, field_paths = args
+    try:
+        f = File(filename)
+        try:
+            return filename, dict((path, f[path].value) for path in field_paths), None
+        finally:
+            f.close()
+    except Exception as exc:
+        # Exceptions may hold objects that can't be sent back from the
+        # worker process, so only their type and message are returned.
+        return filename, None, (exc.__class__.__name__, str(exc))
+
+def read_fields(filenames, field_paths, workers=None):
+    """
+    Read the fields *field_paths* from each file in *filenames*.
+
+    The files are read by a pool of *workers* processes, one per processor
+    by default.  Returns a list of (filename, values, error) for each file,
+    in order.  *values* is a dict of field path to value, or None if the
+    file could not be read, in which case *error* is (exception type name,
+    message) for the error raised.  An error in one file does not stop the
+    others being read.
+    """
+    import multiprocessing
+    tasks = [(filename, list(field_paths)) for filename in filenames]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        return [_read_file_fields(task) for task in tasks]
+    pool = multiprocessing.Pool(workers)
+    try:
+        chunksize = max(1, len(tasks)//(4*workers))
+        return pool.map(_read_file_fields, tasks, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
 """
 if os.path.islink(fullPath):
     # http://www.mail-archive.com/python-list@python.org/msg34223.html
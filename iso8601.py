@@ -251,7 +251,7 @@ def _check_date(s,d,strict):
         parse_date(s, strict=True)
         if not strict:
             raise Exception("exception not raised for strict %r"%s)
-    except ValueError, exc:
+    except ValueError as exc:
         if strict:
             raise Exception("unexpected exception for strict %r\n  %s"
                             %(s,str(exc)))
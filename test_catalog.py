@@ -0,0 +1,92 @@
+"""
+Tests for the catalog of NeXus zip files.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from . import hzf
+from . import catalog
+
+def write_entry(filename, start, program):
+    """
+    Write a file with one entry started at *start* seconds, holding a
+    counter field and an NXdata group which links to it.
+    """
+    f = hzf.File(filename, 'w')
+    try:
+        entry = hzf.group(f, 'entry', 'NXentry')
+        hzf.field(entry, 'start_time', data='', dtype='|S', attrs={'epoch_ms': 1000*start})
+        hzf.field(entry, 'end_time', data='', dtype='|S', attrs={'epoch_ms': 1000*start + 500})
+        hzf.field(entry, 'program_name', data=program, dtype='|S')
+        das = hzf.group(entry, 'DAS_logs', 'NXcollection')
+        counter = hzf.group(das, 'counter', 'NXcollection')
+        hzf.field(counter, 'counts', data=numpy.arange(4, dtype='int32'), dtype='int32')
+        hzf.group(entry, 'data', 'NXdata')
+        hzf.make_links(f, [('/entry/DAS_logs/counter/counts', '/entry/data/counts')])
+    finally:
+        f.close()
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.datadir = os.path.join(self.path, 'data')
+        os.mkdir(self.datadir)
+        self.files = [os.path.join(self.datadir, 'scan%d.nxz' % k) for k in range(2)]
+        write_entry(self.files[0], 1000, 'NICE')
+        write_entry(self.files[1], 2000, 'other')
+        self.catalog = catalog.Catalog(os.path.join(self.path, 'catalog.db'))
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.path)
+
+    def test_query(self):
+        self.assertEqual(self.catalog.update(self.datadir), (2, []))
+        self.assertEqual(self.catalog.update(self.datadir), (0, []))
+        self.assertEqual(self.catalog.query(program_name='NICE'), [(self.files[0], 'entry')])
+        self.assertEqual(self.catalog.query(start=1500), [(self.files[1], 'entry')])
+        self.assertEqual(len(self.catalog.query(nx_class='NXdata')), 2)
+        self.assertEqual(len(self.catalog.query(field='DAS_logs/counter/counts')), 2)
+
+    def test_linked_fields(self):
+        self.catalog.update(self.datadir)
+        self.assertEqual(len(self.catalog.query(field='data/counts')), 2)
+        fields = self.catalog.fields(self.files[0], 'entry')
+        self.assertEqual(fields['data/counts'], fields['DAS_logs/counter/counts'])
+
+    def test_failures(self):
+        bad = os.path.join(self.datadir, 'bad.nxz')
+        with open(bad, 'w') as outfile:
+            outfile.write('junk')
+        count, errors = self.catalog.update(self.datadir)
+        self.assertEqual((count, [path for path, _ in errors]), (2, [bad]))
+        self.assertEqual([path for path, _ in self.catalog.failures()], [bad])
+        # unchanged failures are not read again
+        self.assertEqual(self.catalog.update(self.datadir), (0, []))
+        os.utime(bad, (1, 1))
+        self.assertEqual(len(self.catalog.update(self.datadir)[1]), 1)
+        os.remove(bad)
+        self.catalog.update(self.datadir)
+        self.assertEqual(self.catalog.failures(), [])
+
+    def test_partial_add(self):
+        # A file which fails part way through leaves none of its rows.
+        add = catalog.Catalog._add
+        def failing(cat, path):
+            add(cat, path)
+            raise ValueError("failed after adding the rows")
+        catalog.Catalog._add = failing
+        try:
+            count, errors = self.catalog.update(self.datadir)
+        finally:
+            catalog.Catalog._add = add
+        self.assertEqual((count, len(errors)), (0, 2))
+        self.assertEqual(self.catalog.query(), [])
+        self.assertEqual(self.catalog.fields(self.files[0], 'entry'), {})
+
+if __name__ == '__main__':
+    unittest.main()
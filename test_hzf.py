@@ -0,0 +1,84 @@
+"""
+Tests for the NeXus zip files written by hzf.
+"""
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from . import hzf
+
+def write_tree(path):
+    """
+    Write a small tree of files and directories below *path*.
+    """
+    os.makedirs(os.path.join(path, 'entry', 'DAS_logs'))
+    with open(os.path.join(path, 'entry', 'counts'), 'wb') as outfile:
+        outfile.write(b'1\n2\n3\n' * 1000)
+    with open(os.path.join(path, 'entry', 'DAS_logs', '.attrs'), 'wb') as outfile:
+        outfile.write(b'{"NX_class": "NXcollection"}')
+
+class StreamZipFileTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_stream_matches_zipfile(self):
+        # The streamed archive holds the same members as one written by
+        # zipfile, and reports the same CRCs and sizes.
+        source = os.path.join(self.path, 'tree')
+        write_tree(source)
+        filename = os.path.join(self.path, 'tree.zip')
+        expected = hzf.make_zipfile(filename, source)
+        out = io.BytesIO()
+        actual = hzf.stream_zipfile(out, source)
+        self.assertEqual(expected, actual)
+        a, b = zipfile.ZipFile(filename), zipfile.ZipFile(io.BytesIO(out.getvalue()))
+        try:
+            self.assertEqual(b.testzip(), None)
+            self.assertEqual(sorted(a.namelist()), sorted(b.namelist()))
+            for name in a.namelist():
+                self.assertEqual(a.read(name), b.read(name), name)
+        finally:
+            a.close()
+            b.close()
+
+    def test_extract_changed_keeps_newer(self):
+        source = os.path.join(self.path, 'tree')
+        write_tree(source)
+        filename = os.path.join(self.path, 'tree.zip')
+        hzf.make_zipfile(filename, source)
+        target = os.path.join(self.path, 'target')
+        hzf.extract_changed(filename, target)
+        counts = os.path.join(target, 'entry', 'counts')
+        with open(counts, 'wb') as outfile:
+            outfile.write(b'changed')
+        mtime = os.path.getmtime(filename)
+        os.utime(counts, (mtime + 10, mtime + 10))
+        hzf.extract_changed(filename, target)
+        with open(counts, 'rb') as infile:
+            self.assertEqual(infile.read(), b'changed')
+        os.utime(counts, (mtime - 10, mtime - 10))
+        hzf.extract_changed(filename, target)
+        with open(counts, 'rb') as infile:
+            self.assertEqual(infile.read(), b'1\n2\n3\n' * 1000)
+
+    def test_member_count_limit(self):
+        # The end record counts members in 16 bits, so 65535 members fit
+        # and the next one is refused.
+        out = io.BytesIO()
+        z = hzf.StreamZipFile(out, compression=zipfile.ZIP_STORED)
+        for k in range(0xFFFF):
+            z.writestr('m%d' % k, b'')
+        self.assertRaises(zipfile.LargeZipFile, z.writestr, 'extra', b'')
+        z.close()
+        names = zipfile.ZipFile(io.BytesIO(out.getvalue())).namelist()
+        self.assertEqual(len(names), 0xFFFF)
+        self.assertEqual(names[-1], 'm65534')
+
+if __name__ == '__main__':
+    unittest.main()
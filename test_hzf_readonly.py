@@ -0,0 +1,143 @@
+"""
+Tests for reading NeXus zip files with hzf_readonly.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import numpy
+
+from . import hzf
+from . import hzf_readonly
+
+def write_file(filename, rows, offset=0):
+    """
+    Write a file with an entry holding a field x of *rows* values, a field
+    b of *rows* 2x3 blocks and a text field s of *rows* lines.
+    """
+    f = hzf.File(filename, 'w')
+    try:
+        entry = hzf.group(f, 'entry', 'NXentry')
+        hzf.field(entry, 'x', data=numpy.arange(rows, dtype='int32') + offset, dtype='int32')
+        hzf.field(entry, 'b', data=numpy.arange(rows*6, dtype='float64').reshape(rows, 2, 3) + offset,
+                  dtype='float64')
+        if rows:
+            hzf.field(entry, 's', data=numpy.array(['row %d' % k for k in range(rows)]), dtype='|S')
+    finally:
+        f.close()
+
+class ReadonlyTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filenames = []
+        for k, rows in enumerate([3, 0, 5, 2]):
+            filename = os.path.join(self.path, 'scan%d.nxz' % k)
+            write_file(filename, rows, offset=100*k)
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_read_rows(self):
+        f = hzf_readonly.File(self.filenames[2])
+        try:
+            x = f['entry/x']
+            self.assertEqual(list(x.read_rows(1, 4)), [201, 202, 203])
+            self.assertEqual(list(f['entry/s'].read_rows(3, 5)), [b'row 3', b'row 4'])
+            self.assertEqual(list(x.value), [200, 201, 202, 203, 204])
+        finally:
+            f.close()
+
+    def test_bad_crc(self):
+        zf = zipfile.ZipFile(self.filenames[0])
+        try:
+            info = zf.getinfo('entry/b')
+        finally:
+            zf.close()
+        info.CRC ^= 1
+        archive = hzf_readonly.CachedArchive(self.filenames[0], [info])
+        try:
+            self.assertRaises(zipfile.BadZipfile, archive.read, 'entry/b')
+            self.assertRaises(zipfile.BadZipfile, archive.open('entry/b').read)
+        finally:
+            archive.close()
+
+    def test_stream_archive(self):
+        with open(self.filenames[2], 'rb') as infile:
+            data = infile.read()
+        for source in (data, bytearray(data)):
+            f = hzf_readonly.File(source)
+            try:
+                self.assertEqual(list(f['entry/x'].value), [200, 201, 202, 203, 204])
+            finally:
+                f.close()
+
+    def test_exists(self):
+        f = hzf_readonly.File(self.filenames[0])
+        try:
+            self.assertTrue('entry/x' in f)
+            self.assertTrue(f.exists('/entry/b'))
+            self.assertFalse('entry/nope' in f)
+            self.assertEqual(sorted(f['entry'].keys()), ['b', 's', 'x'])
+        finally:
+            f.close()
+
+    def test_prefetch(self):
+        f = hzf_readonly.File(self.filenames[2])
+        try:
+            self.assertEqual(sorted(f.prefetch(['entry/x', 'entry/b']).get()),
+                             ['/entry/b', '/entry/x'])
+            self.assertEqual(list(f['entry/x'].value), [200, 201, 202, 203, 204])
+        finally:
+            f.close()
+        self.assertEqual(f.values, {})
+
+    def test_virtual_field(self):
+        x = numpy.concatenate([numpy.arange(rows) + 100*k for k, rows in enumerate([3, 0, 5, 2])])
+        v = hzf_readonly.VirtualField(iter(self.filenames), 'entry/x')
+        try:
+            self.assertEqual(v.shape, (10,))
+            self.assertEqual(list(v.value), list(x))
+            self.assertEqual(list(v[2:7]), list(x[2:7]))
+            self.assertEqual(list(v[[9, 0, 4]]), list(x[[9, 0, 4]]))
+            self.assertEqual(v[-1], x[-1])
+        finally:
+            v.close()
+        v = hzf_readonly.VirtualField(self.filenames, 'entry/b')
+        try:
+            self.assertEqual(v.shape, (10, 2, 3))
+            self.assertEqual(v[5, 1, 2], 100*2 + 2*6 + 5)
+        finally:
+            v.close()
+
+    def test_virtual_field_shapes(self):
+        filename = os.path.join(self.path, 'other.nxz')
+        f = hzf.File(filename, 'w')
+        try:
+            entry = hzf.group(f, 'entry', 'NXentry')
+            hzf.field(entry, 'b', data=numpy.zeros((2, 3, 3)), dtype='float64')
+        finally:
+            f.close()
+        self.assertRaises(ValueError, hzf_readonly.VirtualField,
+                          iter([self.filenames[0], filename]), 'entry/b')
+
+    def test_read_fields_errors(self):
+        bad = os.path.join(self.path, 'bad.nxz')
+        with open(bad, 'w') as outfile:
+            outfile.write('junk')
+        missing = os.path.join(self.path, 'missing.nxz')
+        filenames = [self.filenames[0], bad, missing, self.filenames[2]]
+        for workers in (1, 2):
+            results = hzf_readonly.read_fields(filenames, ['entry/x'], workers=workers)
+            self.assertEqual([filename for filename, _, _ in results], filenames)
+            (_, good, error), (_, none, bad_error), (_, _, missing_error), _ = results
+            self.assertEqual(error, None)
+            self.assertEqual(list(good['entry/x']), [0, 1, 2])
+            self.assertEqual(none, None)
+            self.assertEqual(bad_error[0], zipfile.BadZipfile.__name__)
+            self.assertTrue(missing_error[0] in ('IOError', 'OSError', 'FileNotFoundError'))
+
+if __name__ == '__main__':
+    unittest.main()
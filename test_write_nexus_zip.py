@@ -0,0 +1,214 @@
+"""
+Tests for the NeXus zip writer, comparing the files written with the
+writer's options against those written by the default writer.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from . import write_nexus_zip
+from . import hzf
+from . import hzf_readonly
+from . import util
+
+class State(object):
+    pass
+
+def make_state(datadir):
+    state = State()
+    state.datadir = datadir
+    state.scan = 'scanA'
+    state.keep_all_sensor_logs = False
+    state.all_sensor_logs = {'temp.sensor': []}
+    state.sensor_logs = {}
+    state.devices = {
+        'counter': {'description': 'counter', 'type': 'logical_counter', 'fields': {
+            'counts': {'type': 'int32', 'mode': 'counts'},
+            'startTime': {'type': 'time', 'mode': 'state'},
+            'liveTime': {'type': 'float32', 'mode': 'state', 'units': 's'},
+        }},
+        'A3': {'description': 'motor', 'type': 'motor', 'primary': 'softPosition', 'fields': {
+            'softPosition': {'type': 'float32', 'mode': 'state', 'units': 'degrees'},
+        }},
+        'temp': {'description': 'sensor', 'type': 'sensor', 'fields': {
+            'sensor': {'type': 'float32', 'mode': 'log', 'units': 'K'},
+        }},
+    }
+    state.data = {'A3.softPosition': 1.0, 'counter.counts': 0,
+                  'counter.startTime': 0, 'counter.liveTime': 1.0,
+                  'temp.sensor': 300.0,
+                  util.CONTROL_VARIABLES: ['A3.softPosition'],
+                  'trajectory.program': 'test'}
+    state.record = {'time': 1000000}
+    state.timestamp = '2020-01-01T00:00:00'
+    state.current_errors, state.config_errors = set(), set()
+    state.current_warnings, state.config_warnings = set(), set()
+    state.nexus = {'entry$NXentry': {'sample$NXsample': None}}
+    state.time_fields = lambda: set(['counter.startTime'])
+    return state
+
+def write_points(order, writer_class=write_nexus_zip.Writer, open_first=False,
+                 crash_at=None, **kw):
+    """
+    Write one point to each scan named in *order*, three sensor samples
+    per point, and return {file name: {member: contents}}.  If
+    *open_first*, all the scans are opened before any points are written.
+    If *crash_at* is given, a writer writes the first *crash_at* points
+    and is abandoned without closing anything, as if it had crashed, then
+    all of the points are replayed by a new writer in recovery mode.
+    """
+    datadir = tempfile.mkdtemp()
+    try:
+        if crash_at is None:
+            _write(datadir, order, writer_class, open_first, True, kw)
+        else:
+            _write(datadir, order[:crash_at], writer_class, open_first, False, kw)
+            sys.argv.append('--recovery')
+            try:
+                _write(datadir, order, writer_class, open_first, True, kw)
+            finally:
+                sys.argv.remove('--recovery')
+                write_nexus_zip.RECOVERED_SET.clear()
+        return dict(_members(os.path.join(datadir, name))
+                    for name in os.listdir(datadir))
+    finally:
+        shutil.rmtree(datadir)
+
+def _write(datadir, order, writer_class, open_first, close, kw):
+    state = make_state(datadir)
+    writer = writer_class(**kw)
+    writer.configure(state)
+    handles = {}
+    if open_first:
+        for scan in order:
+            if scan not in handles:
+                state.scan = scan
+                handles[scan] = writer.open_scan(state)
+    t = state.record['time']
+    for point, scan in enumerate(order):
+        state.scan = scan
+        if scan not in handles:
+            handles[scan] = writer.open_scan(state)
+        for k in range(3):
+            t += 100
+            state.all_sensor_logs['temp.sensor'].append((t, 300.0 + point + 0.1*k, 0, ''))
+        state.sensor_logs = {'temp.sensor': state.all_sensor_logs['temp.sensor'][-3:]}
+        state.record['time'] = t
+        state.data['A3.softPosition'] = 1.0 + point
+        state.data['counter.counts'] = 10*point
+        state.data['counter.startTime'] = t
+        writer.end_count(state, handles[scan])
+    if close:
+        for scan in handles:
+            state.scan = scan
+            writer.close_scan(state, handles[scan])
+        writer.end(state)
+
+def _members(path):
+    """
+    Return (NeXus file name, {member: contents}) for the output *path*.
+    Zipped output is unpacked, so it compares equal to the unzipped file.
+    """
+    name = os.path.basename(path)
+    if name.endswith('.zip'):
+        name = name[:-len('.zip')]
+        zf = zipfile.ZipFile(path)
+        try:
+            if name in zf.namelist():
+                path = zf.read(name)
+        finally:
+            zf.close()
+    f = hzf_readonly.File(path)
+    try:
+        return name, dict((member, f.zipfile.read(member)) for member in f.zipfile.namelist()
+                          if not member.endswith('/') and not member.endswith('.attrs'))
+    finally:
+        f.close()
+
+class WriterTest(unittest.TestCase):
+    def test_evict_scans_without_points(self):
+        # With one file open at a time, opening scanB must not evict scanA
+        # before its first point.
+        order = ['scanA', 'scanB']*3
+        expected = write_points(order, open_first=True)
+        actual = write_points(order, open_first=True, max_open_scans=1)
+        self.assertEqual(sorted(expected), sorted(actual))
+        for name in expected:
+            self.assertEqual(expected[name], actual[name], name)
+
+    def test_threaded_sensor_window(self):
+        # Points queued for one file must not lose the sensor samples that
+        # the other file's thread has already written and trimmed.
+        order = ['scanA', 'scanB']*5
+        expected = write_points(order, sensor_log_window=2)
+        actual = write_points(order, writer_class=write_nexus_zip.ThreadedWriter,
+                              sensor_log_window=2)
+        self.assertEqual(sorted(expected), sorted(actual))
+        for name in expected:
+            self.assertEqual(expected[name], actual[name], name)
+
+    # Each option changes how the files are written, not what is in them.
+    OPTIONS_ORDER = ['scanA', 'scanB', 'scanA:e2', 'scanB']*2
+
+    def assertSameOutput(self, order, **kw):
+        expected = write_points(order)
+        actual = write_points(order, **kw)
+        self.assertEqual(sorted(expected), sorted(actual))
+        for name in expected:
+            self.assertEqual(expected[name], actual[name], name)
+
+    def test_sensor_log_window(self):
+        self.assertSameOutput(self.OPTIONS_ORDER, sensor_log_window=2)
+
+    def test_max_open_scans(self):
+        self.assertSameOutput(self.OPTIONS_ORDER, max_open_scans=1)
+
+    def test_max_tmp_bytes(self):
+        self.assertSameOutput(self.OPTIONS_ORDER, max_tmp_bytes=1)
+
+    def test_end_workers(self):
+        self.assertSameOutput(self.OPTIONS_ORDER, end_workers=2)
+
+    def test_checkpoint(self):
+        self.assertSameOutput(self.OPTIONS_ORDER, checkpoint=True)
+
+    def test_threaded(self):
+        self.assertSameOutput(self.OPTIONS_ORDER, writer_class=write_nexus_zip.ThreadedWriter)
+
+    def test_archiver(self):
+        archiver = hzf.ArchiveWorker()
+        try:
+            self.assertSameOutput(self.OPTIONS_ORDER, archiver=archiver)
+        finally:
+            archiver.close()
+
+    def test_zip_methods(self):
+        for method in write_nexus_zip.ZIP_METHODS:
+            self.assertSameOutput(self.OPTIONS_ORDER, zipped=True, zip_method=method)
+        self.assertRaises(ValueError, write_nexus_zip.Writer, zip_method="store")
+
+    def test_checkpoint_replay(self):
+        # Replaying after a crash keeps the points the checkpoint says are
+        # already in the files, and gives the same files as a clean run.
+        for crash_at in (1, 3, 6):
+            self.assertSameOutput(self.OPTIONS_ORDER, checkpoint=True, crash_at=crash_at)
+
+    def test_checkpoint_replay_skips_points(self):
+        order = self.OPTIONS_ORDER
+        written = []
+        end_count = write_nexus_zip.Scan.end_count
+        def counted(scan, state):
+            written.append(scan.entry_name)
+            return end_count(scan, state)
+        write_nexus_zip.Scan.end_count = counted
+        try:
+            write_points(order, checkpoint=True, crash_at=6)
+        finally:
+            write_nexus_zip.Scan.end_count = end_count
+        self.assertTrue(len(written) < 6 + len(order), len(written))
+
+if __name__ == '__main__':
+    unittest.main()
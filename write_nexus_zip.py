@@ -3,14 +3,26 @@ Data writer for the NeXus file format.
 """
 from __future__ import print_function
 
-__all__ = ["Writer"]
+__all__ = ["Writer", "ThreadedWriter"]
 
 import sys
 import os
 import json
 import bisect
+import multiprocessing
+import collections
+import copy
+import hashlib
+import shutil
+import tempfile
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from os.path import basename
+from multiprocessing.pool import ThreadPool
 
 import numpy
 
@@ -28,9 +40,15 @@ from .writer import Writer as BaseWriter
 # entry should be appended rather than recreated.
 RECOVERED_SET = set()
 
+# Checkpoints are written next to the file as <file>.ckpt
+CHECKPOINT_EXT = ".ckpt"
+
 # Hardcoded info in configuration
 SAMPLE_GROUP = "sample"  # Must match name in NeXus mapping
 
+# Ways of making the zipped output from the NeXus file
+ZIP_METHODS = ("deflate", "stored", "direct")
+
 RESERVED_ATTRS = set(('mode','name','units','type','label','value','shape'))
 
 @quack.implements(BaseWriter)
@@ -38,32 +56,81 @@ class Writer(BaseWriter):
     """
     Writer for the NeXus file format.
     """
-    def __init__(self, ext=".nxs", zipped=False):
+    def __init__(self, ext=".nxs", zipped=False, sensor_log_window=None,
+                 note_tables=False, max_open_scans=None, max_tmp_bytes=None,
+                 end_workers=None, zip_method="deflate", checkpoint=False,
+                 archiver=None):
         self.ext = ext
         self.zipped = zipped
+        # How the zipped output is made from the NeXus file, which is
+        # itself a zip archive: "deflate" compresses it again into the zip,
+        # "stored" copies it into the zip without compression, and "direct"
+        # renames it to the zip name so the file is only written once.
+        if zip_method not in ZIP_METHODS:
+            raise ValueError("zip_method must be one of %s, not %r"
+                             % (", ".join(ZIP_METHODS), zip_method))
+        self.zip_method = zip_method
+        # Optional hzf.ArchiveWorker which writes the archives in a helper
+        # process; the caller is responsible for closing it.
+        self.archiver = archiver
+        # Limits on the files held open.  When more than max_open_scans
+        # files are open, or their working trees use more than
+        # max_tmp_bytes, the least recently used files are written and
+        # closed, and reopened when their scans become active again.
+        self.max_open_scans = max_open_scans
+        self.max_tmp_bytes = max_tmp_bytes
+        # Number of files to write and zip at the same time in end(); the
+        # default is one per processor.
+        self.end_workers = end_workers
+        # If note_tables is set, notes and error logs are written as rows of
+        # one table per entry rather than as one NXnote group per message.
+        self.note_tables = note_tables
+        # If sensor_log_window is set, the writer takes the sensor samples
+        # out of the state as they arrive, and keeps at most a window of
+        # recent samples per sensor rather than the whole trajectory.
+        self.sensor_log_window = sensor_log_window
+        # If checkpoint is set, a small record of the last record written
+        # to each entry is saved next to the file whenever it is flushed.
+        # In recovery mode, a file whose checkpoint matches it is kept and
+        # the records it already holds are skipped instead of rewritten.
+        self.checkpoint = checkpoint
+        self.checkpoints = {} # path: checkpoint
+        self.resume = {} # path: {entry: time of last record in the file}
         self.active_scan = None
         self.active_scan_handle = None
         self.scans = {}
         self.tmp_paths = {}
+        self.open_paths = collections.OrderedDict() # path: None, oldest first
+        self.evicted = set()
         self.reported_paths = set()
+        self.sensor_logs = {} # device.field: SensorLog
+        self.skeletons = SkeletonCache()
 
     def configure(self, state):
         # Keep the complete history of each sensor for the duration of the
         # trajectory so that each entry can have the complete data.  The
         # temperature log for an individual entry will only contain data from
         # the start of the entry to the end of the final point, not from the
-        # start of the trajectory to the end of the trajectory.
+        # start of the trajectory to the end of the trajectory.  With a
+        # sensor_log_window the history is drained into the writer's own
+        # bounded logs instead of staying in the state.
         state.keep_all_sensor_logs = True
 
-    def open_scan(self, state):
-        #if self.active_scan:
-        #    self.active_scan_handle.close(state,self.zipped)
-            
+    def _scan_key(self, state):
+        """
+        Return the (file path, entry name) for the scan in *state*.
+        """
         try:
             basename,entryname = state.scan.split(':',2)
         except:
             basename,entryname = state.scan,"entry"
-        path = os.path.join(state.datadir, basename+self.ext)
+        return os.path.join(state.datadir, basename+self.ext), entryname
+
+    def open_scan(self, state):
+        #if self.active_scan:
+        #    self.active_scan_handle.close(state,self.zipped)
+            
+        path,entryname = self._scan_key(state)
 
         # Create path to file.  Note that basename may contain path
         # separators, so we can't just check for state.datadir
@@ -76,17 +143,24 @@ class Writer(BaseWriter):
                 exc.__cause__ = None
                 raise exc
     
-        # Delete existing files the first time they are seen during replay
+        # Delete existing files the first time they are seen during replay,
+        # unless the checkpoint says which records they already contain.
         if "--recovery" in sys.argv and path not in RECOVERED_SET and os.path.exists(path):
-            os.remove(path)
             RECOVERED_SET.add(path)
+            ckpt = _read_checkpoint(path)
+            if ckpt is not None:
+                self.checkpoints[path] = ckpt
+                self.resume[path] = dict((k, v['time'])
+                                         for k,v in ckpt['entries'].items())
+            else:
+                os.remove(path)
+                _remove_checkpoint(path)
             
         self.active_scan = path, entryname
-        if not self.active_scan in self.scans:
-            new_scan = Scan(path, entryname, state, self.tmp_paths.get(path, None))
-            self.scans[self.active_scan] = new_scan
-            self.tmp_paths[path] = new_scan.h5file.os_path
+        if not self.active_scan in self.scans or self.active_scan in self.evicted:
+            self._new_scan(state, self.active_scan)
         self.active_scan_handle = self.scans[self.active_scan]
+        self._use_path(state, path)
 
         if self.zipped:
             path = "%s.zip" % (path)         
@@ -105,6 +179,7 @@ class Writer(BaseWriter):
         self.active_scan = None
 
     def end_count(self, state, scan):
+        if self._in_file(state, scan): return
         #print "end count",point
         ##All points in one entry
         ##point = self.point; self.point += 1
@@ -118,29 +193,297 @@ class Writer(BaseWriter):
         self.active_scan_handle.update_events(state)
 
     def add_note(self, state, scan):
+        if self._in_file(state, scan): return
         self.reload_scan(state, scan)
         self.active_scan_handle.add_note(state)
 
+    def _in_file(self, state, scan):
+        """
+        Return True if the record is already in the file being recovered.
+        """
+        entries = self.resume.get(scan[0], None)
+        if not entries or scan[1] not in entries:
+            return False
+        return state.record['time'] <= entries[scan[1]]
+
     def reload_scan(self, state, scan):
         if self.active_scan == scan: return
         self.active_scan = scan
         path,entryname = scan
+        if self.active_scan in self.evicted:
+            self._new_scan(state, self.active_scan)
         self.active_scan_handle = self.scans[self.active_scan]
+        self._use_path(state, path)
+
+    def _new_scan(self, state, scan):
+        path,entryname = scan
+        tmp_path = self.tmp_paths.get(path, None)
+        if tmp_path is not None:
+            # Other entries are open in the same working tree, which is
+            # about to be refreshed from the file; save their changes first.
+            for other,handle in self.scans.items():
+                if other[0] == path and other not in self.evicted and handle.h5file is not None:
+                    handle.flush()
+                    break
+        new_scan = Scan(path, entryname, state, tmp_path,
+                        sensor_logs=self.sensor_logs,
+                        sensor_readers=self.scans,
+                        sensor_log_window=self.sensor_log_window,
+                        skeletons=self.skeletons,
+                        note_tables=self.note_tables,
+                        zip_method=self.zip_method,
+                        checkpoint=(self.checkpoints.setdefault(path, {'entries': {}})
+                                    if self.checkpoint else None),
+                        archiver=self.archiver)
+        self.scans[scan] = new_scan
+        self.evicted.discard(scan)
+        self.tmp_paths[path] = new_scan.h5file.os_path
+
+    def _use_path(self, state, path):
+        """
+        Mark *path* as the most recently used file, and close the least
+        recently used files if there are too many open.
+        """
+        self.open_paths.pop(path, None)
+        self.open_paths[path] = None
+        if self.max_open_scans is None and self.max_tmp_bytes is None:
+            return
+        while len(self.open_paths) > 1:
+            if self.max_open_scans is not None and len(self.open_paths) > self.max_open_scans:
+                pass
+            elif (self.max_tmp_bytes is not None
+                  and sum(_tree_size(self.tmp_paths[p]) for p in self.open_paths
+                          if p in self.tmp_paths) > self.max_tmp_bytes):
+                pass
+            else:
+                break
+            # Entries without points can't be reloaded from the file, since
+            # their fields haven't been written yet, so keep them open.
+            candidates = [p for p in list(self.open_paths)[:-1]
+                          if all(handle.point > 0 for scan,handle in self.scans.items()
+                                 if scan[0] == p and handle.h5file is not None)]
+            if not candidates:
+                break
+            self._evict_path(state, candidates[0])
+
+    def _evict_path(self, state, path):
+        """
+        Write and close all scans in *path*.  Zipping is left until the end
+        since the scans may be reopened.
+        """
+        del self.open_paths[path]
+        for scan,handle in self.scans.items():
+            if scan[0] == path and handle.h5file is not None:
+                handle.close(state, False)
+                handle.evicted = True
+                self.evicted.add(scan)
+        self.tmp_paths.pop(path, None)
 
     def end(self, state):
+        # Entries in the same file share a working tree so they are closed
+        # in turn, but separate files are written and zipped in parallel.
+        # Notifications are sent afterward, in scan order.
+        files = collections.OrderedDict()
         for scan in self.scans:
-            self.scans[scan].close(state, self.zipped)
+            files.setdefault(scan[0], []).append(scan)
+        finish = lambda scans: self._finish_file(state, scans)
+        workers = self.end_workers or multiprocessing.cpu_count()
+        if len(files) > 1 and workers > 1:
+            pool = ThreadPool(min(workers, len(files)))
+            try:
+                results = pool.map(finish, list(files.values()))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [finish(scans) for scans in files.values()]
+        errors = []
+        for zip_paths, file_errors in results:
+            for zip_path in zip_paths:
+                util.report_file_writing(True, zip_path, state.data)
+            errors.extend(file_errors)
         for path in self.reported_paths:
             util.report_file_writing(False, path, state.data)
+        for path in files:
+            _remove_checkpoint(path)
         self.reported_paths.clear()
+        self.checkpoints.clear()
+        self.resume.clear()
         self.tmp_paths.clear()
-        
+        self.open_paths.clear()
+        self.evicted.clear()
+        self.sensor_logs.clear()
+        self.skeletons.clear()
+        for scan,exc in errors:
+            writer.warn("%s (%s) while closing %s:%s"
+                        % (exc.__class__.__name__, str(exc), scan[0], scan[1]))
+        if errors:
+            raise errors[0][1]
+
+    def _finish_file(self, state, scans):
+        """
+        Close the scans in one file, returning the zip files written and
+        the (scan, exception) pairs for the scans which failed.
+        """
+        zip_paths, errors = [], []
+        # Close all the entries of the file before zipping it once, whether
+        # or not some of them were evicted.  Entries closed by close_scan
+        # have already been zipped.
+        unzipped = False
+        for scan in scans:
+            handle = self.scans[scan]
+            try:
+                if scan in self.evicted:
+                    unzipped = True
+                elif handle.h5file is not None:
+                    handle.close(state, False, report=False)
+                    unzipped = True
+            except Exception as exc:
+                errors.append((scan, exc))
+        if self.zipped and unzipped and not errors:
+            scan = scans[-1]
+            try:
+                zip_paths.append(self.scans[scan].zip_output(state, scan[0], report=False))
+            except Exception as exc:
+                errors.append((scan, exc))
+        return [p for p in zip_paths if p is not None], errors
+
+
+class ThreadedWriter(Writer):
+    """
+    Writer for the NeXus file format which writes each file on its own
+    thread.
+
+    The callbacks for a scan are queued to the thread for its file and run
+    in order, so a slow scan (e.g., large detector frames) doesn't hold up
+    the caller or the scans in other files.  Entries in the same file share
+    a working tree, so they share a thread.  At most *max_pending* callbacks
+    are queued for each file; beyond that the caller waits.
+
+    The state is copied when the callback is queued.  Sensor samples are
+    moved into the writer's sensor logs on the caller's thread, and each
+    point records how many samples it covers.  With a *sensor_log_window*,
+    the logs keep the samples still queued for the slowest file.
+
+    Errors raised on the writer threads are collected and raised by
+    :meth:`drain`, which waits for the queued work to complete.  Files
+    are not closed to make room for others, so *max_open_scans* and
+    *max_tmp_bytes* are not supported.
+    """
+    def __init__(self, max_pending=16, **kw):
+        if kw.get('max_open_scans', None) is not None or kw.get('max_tmp_bytes', None) is not None:
+            raise ValueError("ThreadedWriter does not support max_open_scans or max_tmp_bytes")
+        Writer.__init__(self, **kw)
+        self.max_pending = max_pending
+        self.workers = {} # path: (queue, thread)
+        self.lock = threading.Lock()
+        self.errors = [] # (scan, exception)
+        self.zip_paths = []
+
+    def open_scan(self, state):
+        # Other entries of the file may be replaced, so let them finish.
+        path,_ = self._scan_key(state)
+        if path in self.workers:
+            self.workers[path][0].join()
+        return Writer.open_scan(self, state)
+
+    def close_scan(self, state, scan):
+        self._submit(scan, 'close', _snapshot(state), self.zipped, False)
+        self.active_scan = None
+
+    def end_count(self, state, scan):
+        if self._in_file(state, scan): return
+        counts = self._ingest_sensor_logs(state)
+        self._submit(scan, 'end_count', _snapshot(state), counts)
+
+    def update_events(self, state, scan):
+        self._submit(scan, 'update_events', _snapshot(state))
+
+    def add_note(self, state, scan):
+        if self._in_file(state, scan): return
+        self._submit(scan, 'add_note', _snapshot(state))
+
+    def drain(self, state):
+        """
+        Wait for the queued callbacks to complete.  Zip files written in
+        the meantime are reported, and the first error is raised after
+        warning about all of them.
+        """
+        for tasks,_ in list(self.workers.values()):
+            tasks.join()
+        with self.lock:
+            zip_paths, self.zip_paths = self.zip_paths, []
+            errors, self.errors = self.errors, []
+        for zip_path in zip_paths:
+            util.report_file_writing(True, zip_path, state.data)
+        for scan,exc in errors:
+            writer.warn("%s (%s) while writing %s:%s"
+                        % (exc.__class__.__name__, str(exc), scan[0], scan[1]))
+        if errors:
+            raise errors[0][1]
+
+    def end(self, state):
+        try:
+            self.drain(state)
+        finally:
+            for tasks,_ in self.workers.values():
+                tasks.put(None)
+            for _,thread in self.workers.values():
+                thread.join()
+            self.workers.clear()
+            Writer.end(self, state)
+
+    def _ingest_sensor_logs(self, state):
+        """
+        Move new sensor samples into the writer's logs, returning the
+        number of samples for each sensor up to the current point.
+        """
+        counts = {}
+        for sensor,data in state.all_sensor_logs.items():
+            log = self.sensor_logs.get(sensor, None)
+            if log is None:
+                if not data: continue
+                log = SensorLog(window=self.sensor_log_window)
+                self.sensor_logs[sensor] = log
+            with log.lock:
+                if data: log.update(data)
+                counts[sensor] = log.count
+        return counts
+
+    def _submit(self, scan, method, *args):
+        if scan[0] not in self.workers:
+            tasks = queue.Queue(self.max_pending)
+            thread = threading.Thread(target=self._work, args=(tasks,))
+            thread.daemon = True
+            thread.start()
+            self.workers[scan[0]] = tasks, thread
+        self.workers[scan[0]][0].put((scan, method, args))
+
+    def _work(self, tasks):
+        while True:
+            task = tasks.get()
+            try:
+                if task is None:
+                    return
+                scan,method,args = task
+                try:
+                    result = getattr(self.scans[scan], method)(*args)
+                except Exception as exc:
+                    with self.lock:
+                        self.errors.append((scan, exc))
+                else:
+                    if method == 'close' and result is not None:
+                        with self.lock:
+                            self.zip_paths.append(result)
+            finally:
+                tasks.task_done()
+
 
 class Scan(object):
     """
     Internal object representing a scan in the nexus writer.
     """
-    def end_count(self, state):
+    def end_count(self, state, sensor_counts=None):
         # Cache fields that are stored in ms but need to be seconds
         if self.time_fields is None: 
             self.time_fields = state.time_fields()
@@ -157,7 +500,8 @@ class Scan(object):
         # store the fields
         #print self.das,"ending counts",point
         links_to_update = []
-        for source,dataset in sorted(self.fields.items()):
+        values = {}
+        for source in self.fields:
             # Normal data is in state.data, but sensor summary statistics must
             # be retrieved from sensor_data.
             #print "source",source,fields.get(source,"not available")
@@ -166,11 +510,18 @@ class Scan(object):
             # Make sure times are delta seconds
             if source in self.time_fields and value is not None:
                 value = 0.001*(value - self.start)
-            dataset.store(value, self.point, links_to_update)
+            values[source] = value
+        unchanged = self._unchanged_fields(values) if self.point > 0 else ()
+        for source,dataset in sorted(self.fields.items()):
+            if source in unchanged: continue
+            if source in self._packed_sources:
+                # The field is becoming a vector; repack what remains.
+                self._packed = None
+            dataset.store(values[source], self.point, links_to_update)
         h5nexus.update_hard_links(self.das.parent, links_to_update)
 
         # Store environment data collected while the point was being measured
-        self._write_sensor_logs(state)
+        self._write_sensor_logs(state, sensor_counts)
         # Remember when the last point ended; this must be after write_sensor_logs
         # in order for the logic to work on reloaded entries.
         self.end = state.record['time']  
@@ -189,75 +540,194 @@ class Scan(object):
 
         # Flush buffers after every point is written
         #print "---- flush"
-        self.h5file.flush()
+        self._update_checkpoint(state)
+        self.flush()
 
     def update_events(self, state):
         pass
 
+    def _unchanged_fields(self, values):
+        """
+        Return the sources of the fields still stored as a single number
+        whose value for this point is the same as the stored value.
+
+        Rather than comparing the fields one by one, the stored values
+        are packed into one array per type, and compared with the values
+        for the point in one go.  Fields in a type group whose values
+        can't be packed are left for :meth:`Dataset.store` to handle.
+        """
+        if self._packed is None:
+            groups = {}
+            for source,dataset in self.fields.items():
+                first = dataset._first
+                if (first is not None and first.shape == (1,)
+                        and first.dtype.kind in 'biuf' and first.dtype == dataset.dtype):
+                    groups.setdefault(first.dtype, []).append(source)
+            self._packed = [(dtype, sources, numpy.concatenate(
+                                [self.fields[s]._first for s in sources]))
+                            for dtype,sources in groups.items()]
+            self._packed_sources = set(s for _,sources,_ in self._packed for s in sources)
+        unchanged = set()
+        for dtype,sources,firsts in self._packed:
+            try:
+                current = numpy.asarray([values[s] for s in sources], dtype=dtype)
+            except Exception:
+                continue
+            if current.shape != firsts.shape:
+                continue
+            same = util.equal_nan(firsts, current)
+            unchanged.update(s for s,eq in zip(sources, same) if eq)
+        return unchanged
+
+    def flush(self):
+        """
+        Write the file, along with its checkpoint if there is one.
+        """
+        self.h5file.flush()
+        if self.checkpoint is not None:
+            _write_checkpoint(self.h5file.filename, self.checkpoint)
+
+    def _update_checkpoint(self, state):
+        """
+        Record the last record written to the entry.  The checkpoint is
+        saved when the file is next written.
+        """
+        if self.checkpoint is None: return
+        self.checkpoint['entries'][self.entry_name] = {
+            'time': state.record['time'],
+            'point': self.point,
+            'start': self.start,
+            'end': self.end,
+            'collection_time': float(self.collection_time),
+            'sensors': dict(self.sensor_times),
+            }
+
     def add_note(self, state):
-        if "notes" not in self.das:
+        if state.record['mimetype'] == 'application/json':
+            data = json.dumps(state.record['mimedata'])
+        else:
+            data = state.record['mimedata']
+        note = dict(date=state.timestamp, type=state.record['mimetype'],
+                    description=state.record['description'], data=data,
+                    point=self.point)
+        tables = self._use_note_tables("notes")
+        if not tables and "notes" not in self.das:
             h5nexus.group(self.das, "notes", 'NXcollection')
         path = 'notes/note%d'%self.point
-        if path in self.das:
+        if self._has_note(path):
             for ext in 'abcdefghijklmnopqrstuvwxyz':
-                if path+ext not in self.das: break
+                if not self._has_note(path+ext): break
             else:
                 raise RuntimeError("More than 27 notes for one point not supported")
             path = path + ext
+        if tables:
+            self._append_note(path, note)
+            self._update_checkpoint(state)
+            return
         h5nexus.group(self.das, path, 'NXnote')
         h5nexus.field(self.das[path], 'date', data=state.timestamp, dtype='|S')
         h5nexus.field(self.das[path], 'type', data=state.record['mimetype'], dtype='|S')
         h5nexus.field(self.das[path], 'description',  dtype='|S',
                       data=state.record['description'])
-        if state.record['mimetype'] == 'application/json':
-            data = json.dumps(state.record['mimedata'])
-        else:
-            data = state.record['mimedata']
         h5nexus.field(self.das[path], 'data', data=data, dtype='|S')
         h5nexus.field(self.das[path], 'point', data=self.point, units="", dtype='int32')
+        self._update_checkpoint(state)
         
-    def close(self, state, zipped):
+    def close(self, state, zipped, report=True):
+        """
+        Write and close the file.  In zipped mode, return the name of the
+        zip file if it was written, reporting it to the client unless
+        *report* is False.
+        """
         # Note: sensor values after the last point are not required
         # self._write_sensor_readings()
         
+        zip_path = None
         if self.h5file is not None:
             
-            if zipped:
-                file_path = self.h5file.filename           
+            file_path = self.h5file.filename           
             self.h5file.close()
             self.h5file = None         
+            if self.checkpoint is not None and not zipped:
+                _write_checkpoint(file_path, self.checkpoint)
             
             if zipped:
-                try:
-                    self.zip_file(file_path)
-                    os.remove(file_path)
-                    util.report_file_writing(True, "%s.zip" % (file_path), state.data)
-                except Exception as e:
-                    writer.warn(e)
+                zip_path = self.zip_output(state, file_path, report)
                     
             # Eventually release the handles we are holding within the file
             del self.fields
             del self.das
+        return zip_path
     
+    def zip_output(self, state, file_path, report=True):
+        try:
+            if self.zip_method == "direct":
+                # The NeXus file is already a zip archive
+                os.rename(file_path, "%s.zip" % (file_path))
+            else:
+                self.zip_file(file_path)
+                os.remove(file_path)
+            if report:
+                util.report_file_writing(True, "%s.zip" % (file_path), state.data)
+            return "%s.zip" % (file_path)
+        except Exception as e:
+            writer.warn(e)
+
     def zip_file(self,file_path):
         
-        zf = zipfile.ZipFile("%s.zip" % (file_path), "w",zipfile.ZIP_DEFLATED)
-        zf.write(file_path,basename(file_path))
-        zf.close()
+        # The NeXus file is already compressed, so deflating it again
+        # gains little over storing it.
+        if self.zip_method == "stored":
+            compression = zipfile.ZIP_STORED
+        else:
+            compression = zipfile.ZIP_DEFLATED
+        zip_path = "%s.zip" % (file_path)
+        if self.archiver is not None:
+            self.archiver.zip_file(zip_path, file_path, basename(file_path), compression)
+        else:
+            h5nexus.zip_file(zip_path, file_path, basename(file_path), compression)
     
-    def __init__(self, path, entry_name, state, tmp_path=None):
+    def __init__(self, path, entry_name, state, tmp_path=None,
+                 sensor_logs=None, sensor_readers=None, sensor_log_window=None, skeletons=None,
+                 note_tables=False, zip_method="deflate", checkpoint=None,
+                 archiver=None):
         # Things to remember between calls
 
+        # columnar sensor histories, shared between all scans of the writer
+        self.sensor_logs = sensor_logs if sensor_logs is not None else {}
+        # all scans reading the sensor logs, {key: scan}; samples that any of
+        # them still need are kept in the logs
+        self.sensor_readers = sensor_readers
+        # set by the writer when the scan is closed to make room for others
+        # and will be reopened later
+        self.evicted = False
+        self.sensor_log_window = sensor_log_window
+        # prebuilt DAS_logs trees, shared between all scans of the writer
+        self.skeletons = skeletons
+        # notes and error logs as rows in a table, with the row names
+        # for each table loaded on first use
+        self.note_tables = note_tables
+        self._note_names = {}
+        self.zip_method = zip_method
+        # checkpoint for the file, shared between all scans of the file
+        self.checkpoint = checkpoint
+        self.archiver = archiver
+
         # all scan data goes to the DAS_logs, so remember where it is
         # location->value map for default values stored at every point
         self.fields = {}
         self.sensor_list = {} # device.field: index
+        self.sensor_times = {} # device.field: time of last sample written
+        # values of the single valued fields packed by type for comparison
+        self._packed = None
+        self._packed_sources = set()
         self.time_fields = None
         self.scanning = True #'Scan' in record
         self.entry_name = entry_name
         
         #print "working on",path
-        self.h5file = h5nexus.open(path, mode='a', creator='NICE data writer', os_path = tmp_path)
+        self.h5file = h5nexus.open(path, mode='a', creator='NICE data writer', os_path = tmp_path,
+                                   archiver = archiver)
         #print self.h5file.keys()
         
         if self.entry_name in self.h5file:
@@ -279,17 +749,28 @@ class Scan(object):
         entry = h5nexus.group(self.h5file, self.entry_name, 'NXentry')        
         h5nexus.field(entry,'start_time', dtype='|S',
                       data=iso8601.format_date(self.start*0.001, precision=3),
-                      label='measurement start time')
+                      label='measurement start time',
+                      attrs={'epoch_ms': self.start})
         h5nexus.field(entry,'program_name', dtype='|S',
                       data=state.data.get('trajectory.program',''),
                       label="program",
                       attrs={'version': state.data.get('trajectory.version',''),
                              'configuration': state.data.get('trajectory.command','')})
-        self.das = h5nexus.group(entry, 'DAS_logs', 'NXcollection')
+        # The device tree only depends on the configuration, so build it
+        # once and copy it into each new entry with the same configuration.
+        key = self.skeletons.key(self, state) if self.skeletons is not None else None
+        skeleton = self.skeletons.get(key) if key is not None else None
+        if skeleton is not None:
+            skeleton.copy_to(self, entry)
+        else:
+            self.das = h5nexus.group(entry, 'DAS_logs', 'NXcollection')
         self._update_timestamps()
         
-        for k,v in state.devices.items():
-            self.create_device(state, k, v)
+        if skeleton is None:
+            for k,v in state.devices.items():
+                self.create_device(state, k, v)
+            if key is not None:
+                self.skeletons.store(key, self)
         self._write_error_log(state, 0, 'error', state.config_errors)
         self._write_error_log(state, 0, 'warning', state.config_warnings)
 
@@ -303,9 +784,17 @@ class Scan(object):
         """
         entry = self.h5file[self.entry_name]
         self.das = entry['DAS_logs']
-        self.start = int(1000*iso8601.seconds_since_epoch(util.bytes_to_str(entry['start_time'].value[0])))
-        self.end = int(1000*iso8601.seconds_since_epoch(util.bytes_to_str(entry['end_time'].value[0])))
-        self.collection_time = entry['collection_time'].value[0]
+        self.start = _epoch_ms(entry['start_time'])
+        self.end = _epoch_ms(entry['end_time'])
+        # The checkpoint has the exact collection time and knows which
+        # sensor samples after the last point were written.
+        saved = (self.checkpoint['entries'].get(self.entry_name, None)
+                 if self.checkpoint is not None else None)
+        if saved is not None:
+            self.collection_time = saved['collection_time']
+            self.sensor_times = dict(saved['sensors'])
+        else:
+            self.collection_time = _collection_time(entry['collection_time'])
         self._update_timestamps()
         for k,v in state.devices.items():
             self.reload_device(state, k, v)
@@ -655,9 +1144,16 @@ class Scan(object):
         if not messages: return
         messages = dict(messages)
         #print "errors",self.point,messages
+        path = 'error_log/%s%03d'%(level,self.point)
+        if self._use_note_tables("error_log"):
+            if not self._has_note(path):
+                self._append_note(path, dict(
+                    date=state.timestamp, type='application/json',
+                    description='%s messages from DAS devices'%level,
+                    data=json.dumps(messages), point=point))
+            return
         if "error_log" not in self.das:
             h5nexus.group(self.das, "error_log", 'NXcollection')
-        path = 'error_log/%s%03d'%(level,self.point)
         h5nexus.group(self.das, path, 'NXnote')
         h5nexus.field(self.das[path], 'date', data=state.timestamp, dtype='|S')
         h5nexus.field(self.das[path], 'type', data='application/json', dtype='|S')
@@ -665,48 +1161,137 @@ class Scan(object):
         h5nexus.field(self.das[path], 'data', data=json.dumps(messages), dtype='|S')
         h5nexus.field(self.das[path], 'point', data=point, units="", dtype='int32')
 
-    def _write_sensor_logs(self, state):
+    def _use_note_tables(self, table):
+        """
+        True if notes in *table* are written as table rows.  Tables are
+        only used if enabled and the entry doesn't already hold notes in
+        the one group per note layout.
         """
-        Write any new sensor values to the active sensors.
+        if table in self._note_names:
+            return True
+        if table in self.das:
+            if self.das[table].attrs.get('record_class', None) != 'NXnote':
+                return False
+            names = self.das[table+"/name"].value
+            self._note_names[table] = set(util.bytes_to_str(v) for v in names)
+            return True
+        return self.note_tables
+
+    def _has_note(self, path):
+        table, name = path.split('/')
+        if table in self._note_names:
+            return name in self._note_names[table]
+        return path in self.das
+
+    def _append_note(self, path, note):
+        """
+        Add *note* as a new row of the table, using the last part of *path*
+        as the row name.
+        """
+        table, name = path.split('/')
+        row = dict(note, name=name)
+        new_table = table not in self._note_names
+        if new_table:
+            h5nexus.group(self.das, table, 'NXcollection',
+                          attrs={'record_class': 'NXnote'})
+            self._note_names[table] = set()
+        for column,dtype,units in _NOTE_COLUMNS:
+            value = row[column]
+            if dtype == '|S': value = util.str_to_bytes(value)
+            value = numpy.asarray([value], dtype=dtype)
+            if new_table:
+                h5nexus.field(self.das, table+"/"+column, data=value,
+                              maxshape=[None], units=units, dtype=dtype)
+            else:
+                h5nexus.extend(self.das[table+"/"+column], value)
+        self._note_names[table].add(name)
+
+    def _write_sensor_logs(self, state, sensor_counts=None):
+        """
+        Write any new sensor values to the active sensors.  If
+        *sensor_counts* is given, only the samples up to the count for
+        each sensor are written; later samples belong to later points.
         
         Note: this must happen before the "end" attribute is updated so that
         it can include any points since the last counts ended.
         """
         #print "=============",state.record['time']-self.start,self.start,self.end-self.start
         for sensor, index in self.sensor_list.items():
-            target = sensor.replace('.','/')
             data = state.all_sensor_logs.get(sensor,None)
-            #print sensor, data
-            #print "updating",sensor,"from",index,"to",(len(data) if data else 0)
-            if data and len(data) > index:
-                # Update index for next round.  Do this before checking if
-                # this is the first update (i.e., index == -1) so that we
-                # can short circuit with continue
-                self.sensor_list[sensor] = len(data)
-                if index == -1: # start entry
-                    # if this is the first update, lookup the start time of the
-                    # entry in the logs, and include the first value before it.
-                    time,_,_,_ = zip(*data)
-                    index = bisect.bisect_right(time, self.start) - 1
-                    if index < 0: index = 0
-                    #print "first lookup",[t-self.start for t in time],index
-                    if index >= len(data): continue
-                elif index == -2: # reload entry
-                    # on reload, start recording the logs at the first log
-                    # after the end of the last point
-                    time,_,_,_ = zip(*data)
-                    index = bisect.bisect_right(time, self.end)
-                    #print "reload lookup",self.end-self.start,[t-self.start for t in time],index
-                    if index >= len(data): continue
-
-                # grab data since last index and convert to arrays
-                time,value,_validity,_msg = zip(*data[index:])
-                value = numpy.asarray(value)
-                time = 0.001*(numpy.asarray(time) - self.start)
-                # Add the arrays to the end of the log field
-                #print "+++",sensor,value,time
-                h5nexus.extend(self.das[target+"/time"], time)
-                h5nexus.extend(self.das[target+"/value"], value)
+            log = self.sensor_logs.get(sensor, None)
+            if log is None:
+                if not data: continue
+                log = SensorLog(window=self.sensor_log_window)
+                self.sensor_logs[sensor] = log
+            # The log is shared with scans being written on other threads
+            with log.lock:
+                # Convert only the samples which arrived since the last update
+                # into the columnar history for the sensor.
+                if data: log.update(data)
+                count = log.count
+                if sensor_counts is not None:
+                    count = min(count, sensor_counts.get(sensor, count))
+                self._write_sensor_log(sensor, index, log, count)
+
+    def _write_sensor_log(self, sensor, index, log, count):
+        #print "updating",sensor,"from",index,"to",count
+        if count > index:
+            # Update index for next round.  Do this before checking if
+            # this is the first update (i.e., index == -1) so that we
+            # can short circuit with return
+            self.sensor_list[sensor] = count
+            if index == -1: # start entry
+                # if this is the first update, lookup the start time of the
+                # entry in the logs, and include the first value before it.
+                index = log.bisect_right(self.start) - 1
+                if index < 0: index = 0
+                if index >= count: return
+            elif index == -2: # reload entry
+                # on reload, start recording the logs at the first log
+                # after the end of the last point, or after the last
+                # sample written if the checkpoint says
+                index = log.bisect_right(self.sensor_times.get(sensor, self.end))
+                if index >= count: return
+
+            if index < log.first - (1 if log.prior is not None else 0):
+                writer.warn("sensor log for %s is missing samples older than the %d sample window"
+                            % (sensor, log.window))
+
+            # grab data since last index; value is a view on the history
+            time, value = log.since(index, count)
+            if not len(time): return
+            # Add the arrays to the end of the log field
+            #print "+++",sensor,value,time
+            target = sensor.replace('.','/')
+            h5nexus.extend(self.das[target+"/time"], 0.001*(time - self.start))
+            h5nexus.extend(self.das[target+"/value"], value)
+            self.sensor_times[sensor] = float(time[-1])
+            log.trim(self._sensor_needed(sensor, log))
+
+    def _sensor_needed(self, sensor, log):
+        """
+        Return the first sample of *log* still needed by any scan reading
+        the sensor.
+        """
+        readers = self.sensor_readers.values() if self.sensor_readers else [self]
+        needed = [scan._sensor_cursor(sensor, log) for scan in readers]
+        needed = [index for index in needed if index is not None]
+        return min(needed) if needed else log.count
+
+    def _sensor_cursor(self, sensor, log):
+        """
+        Return the first sample of *log* this scan has yet to write, or None
+        if it doesn't record the sensor or has been closed for good.
+        """
+        if self.h5file is None and not self.evicted:
+            return None
+        index = self.sensor_list.get(sensor, None)
+        if index is None:
+            return None
+        if index == -1:
+            return max(log.bisect_right(self.start) - 1, 0)
+        resume = log.bisect_right(self.sensor_times.get(sensor, self.end))
+        return resume if index == -2 else min(index, resume)
 
     def _update_timestamps(self):
         """
@@ -715,12 +1300,15 @@ class Scan(object):
         end_time_str = iso8601.format_date(self.end*0.001, precision=3)
         if 'end_time' in self.das.parent:
             self.das.parent['end_time'][:] = util.str_to_bytes(end_time_str)
+            self.das.parent['end_time'].attrs['epoch_ms'] = self.end
             self.das.parent['duration'][0] = (self.end-self.start)*0.001
             self.das.parent['collection_time'][0] = self.collection_time
+            self.das.parent['collection_time'].attrs['seconds'] = float(self.collection_time)
         else:
             h5nexus.field(self.das.parent,'end_time',
                           data=end_time_str, dtype='|S',
-                          label='measurement end time')
+                          label='measurement end time',
+                          attrs={'epoch_ms': self.end})
             h5nexus.field(self.das.parent,'duration',
                           data=[(self.end-self.start)*0.001],
                           units='s', dtype='float32',
@@ -728,8 +1316,91 @@ class Scan(object):
             h5nexus.field(self.das.parent,'collection_time',
                           data=[self.collection_time],
                           units='s', dtype='float32',
-                          label='total time detectors were active')
+                          label='total time detectors were active',
+                          attrs={'seconds': float(self.collection_time)})
+
 
+def _snapshot(state):
+    """
+    Copy of the parts of *state* that change from point to point.  The
+    sensor samples are in the writer's logs, so they are not copied.
+    """
+    snapshot = copy.copy(state)
+    snapshot.data = dict(state.data)
+    snapshot.record = dict(state.record)
+    snapshot.sensor_logs = dict((k, list(v)) for k,v in state.sensor_logs.items())
+    snapshot.all_sensor_logs = {}
+    for attr in ('current_errors', 'current_warnings'):
+        if hasattr(state, attr):
+            setattr(snapshot, attr, set(getattr(state, attr)))
+    return snapshot
+
+def _read_checkpoint(path):
+    """
+    Return the checkpoint for the file *path*, or None if there isn't one
+    or it doesn't describe the file as it is on disk.
+    """
+    try:
+        with open(path+CHECKPOINT_EXT) as fd:
+            ckpt = json.load(fd)
+        st = os.stat(path)
+    except (IOError, OSError, ValueError):
+        return None
+    if ckpt.get('archive', None) != [st.st_size, st.st_mtime]:
+        return None
+    return ckpt
+
+def _write_checkpoint(path, ckpt):
+    """
+    Save the checkpoint for the file *path* as it is now on disk.  The
+    checkpoint is written to a temporary file and renamed so that it is
+    never seen half written.
+    """
+    st = os.stat(path)
+    ckpt['archive'] = [st.st_size, st.st_mtime]
+    tmp = path + CHECKPOINT_EXT + ".tmp"
+    with open(tmp, 'w') as fd:
+        json.dump(ckpt, fd)
+    os.rename(tmp, path + CHECKPOINT_EXT)
+
+def _remove_checkpoint(path):
+    try:
+        os.remove(path + CHECKPOINT_EXT)
+    except OSError:
+        pass
+
+def _epoch_ms(node):
+    """
+    Return the time in a start_time/end_time field as ms since the epoch.
+
+    Entries written without the epoch_ms attribute fall back to parsing
+    the date string, which is truncated to the millisecond.
+    """
+    if 'epoch_ms' in node.attrs:
+        return int(node.attrs['epoch_ms'])
+    return int(1000*iso8601.seconds_since_epoch(util.bytes_to_str(node.value[0])))
+
+def _collection_time(node):
+    """
+    Return the collection time in seconds from the collection_time field.
+
+    Entries written without the seconds attribute fall back to the value
+    of the field, which is stored as float32.
+    """
+    if 'seconds' in node.attrs:
+        return node.attrs['seconds']
+    return float(node.value[0])
+
+
+# Columns of the note and error log tables: name, dtype, units
+_NOTE_COLUMNS = [
+    ('name', '|S', None),
+    ('date', '|S', None),
+    ('type', '|S', None),
+    ('description', '|S', None),
+    ('data', '|S', None),
+    ('point', 'int32', ''),
+    ]
 
 def _nicetype_to_dtype(nicetype, attrs=None):
     if nicetype == "enum":
@@ -861,7 +1532,7 @@ class Dataset(object):
         #if echo: print "storing",self.path,point,value
         # Note: conversion could fail for user variables
         try:
-            value = numpy.asarray([original], dtype = self.dtype)
+            value = _as_point(original, self.dtype)
         except:
             value = self.default
             writer.warn("could not interpret value for %r as %s: %s"
@@ -969,7 +1640,9 @@ class Dataset(object):
             if k == 'units': self.units = v
             elif k == 'long_name': self.label = v
             else: self.attrs[k] = v
-        if node.value.shape[0] == 1:
+        # Only the shape is needed to tell a scalar field from a column,
+        # so don't read the data unless it is the single stored value.
+        if node.shape[0] == 1:
             self._first = node.value
         else:
             self._first = None
@@ -977,6 +1650,260 @@ class Dataset(object):
         #    print "Loading",node.name, self._first
         
 
+class SensorLog(object):
+    """
+    Columnar history for one sensor.
+
+    The sensor log in the state is a list of (time, value, validity, message)
+    tuples which grows for the duration of the trajectory.  Rather than
+    unpacking the whole list on every point, the new samples are appended
+    to preallocated time and value arrays, with *size* marking the number of
+    samples stored.  Storage doubles when full, so the cost of adding a
+    sample is amortized constant.
+
+    Samples are numbered from the start of the trajectory; *count* is the
+    number of samples seen and *first* is the number of the first sample
+    still held.  If *window* is given, the samples are removed from the
+    state log as they are read, and once the columns hold two windows worth
+    of samples, :meth:`trim` shifts them down to the most recent *window*
+    samples, keeping any that an open scan has yet to write, so the window
+    may be exceeded while a scan lags behind.  The last evicted sample is
+    kept as *prior* so that a scan which starts just after an eviction can
+    still record the value at its start.
+    """
+    def __init__(self, capacity=256, window=None):
+        if window is not None:
+            capacity = max(capacity, 2*window)
+        self.capacity = capacity
+        self.window = window
+        self.time = numpy.empty(capacity, dtype='float64')
+        self.value = None
+        self.size = 0
+        self.first = 0
+        self.prior = None
+        # held while the log is updated or read
+        self.lock = threading.Lock()
+
+    @property
+    def count(self):
+        return self.first + self.size
+
+    def update(self, data):
+        """
+        Add the samples in *data* beyond those already stored.
+        """
+        if self.window is not None:
+            # The writer owns the history; take the samples out of the state.
+            new = data[:]
+            del data[:]
+        else:
+            if len(data) < self.count:
+                # The state started a new history; start over.
+                self.size = self.first = 0
+                self.prior = None
+            new = data[self.count:]
+        if not new:
+            return
+        time,value,_validity,_msg = zip(*new)
+        self._append(numpy.asarray(time, dtype='float64'),
+                     numpy.asarray(value))
+
+    def _append(self, time, value):
+        n = self.size + len(time)
+        if self.value is None:
+            self.value = numpy.empty(self.capacity, dtype=value.dtype)
+        elif not numpy.can_cast(value.dtype, self.value.dtype):
+            # e.g., longer strings than before, or floats in an int log
+            dtype = numpy.promote_types(self.value.dtype, value.dtype)
+            self.value = self.value.astype(dtype)
+        if n > self.capacity:
+            while self.capacity < n: self.capacity *= 2
+            self.time = _resize(self.time, self.capacity)
+            self.value = _resize(self.value, self.capacity)
+        self.time[self.size:n] = time
+        self.value[self.size:n] = value
+        self.size = n
+
+    def trim(self, stop=None):
+        """
+        Drop old samples once the log holds two windows worth.  This is
+        called after the samples have been written to the active scan, and
+        keeps sample *stop* and later, which other scans still need.
+        """
+        if self.window is not None and self.size >= 2*self.window:
+            n = self.size - self.window
+            if stop is not None:
+                n = min(n, stop - self.first)
+            if n > 0:
+                self._evict(n)
+
+    def _evict(self, n):
+        self.prior = self.time[n-1], self.value[n-1]
+        keep = self.size - n
+        self.time[:keep] = self.time[n:self.size].copy()
+        self.value[:keep] = self.value[n:self.size].copy()
+        self.first += n
+        self.size = keep
+
+    def bisect_right(self, t):
+        """
+        Number of the first sample after time *t*.
+        """
+        if self.prior is not None and t < self.prior[0]:
+            return self.first - 1
+        index = numpy.searchsorted(self.time[:self.size], t, side='right')
+        return self.first + int(index)
+
+    def since(self, index, stop=None):
+        """
+        Return views of the time and value columns from sample *index* to
+        sample *stop*, or the end.  Samples that are no longer held are
+        skipped, except for the last evicted sample, which is returned if
+        it is requested.
+        """
+        start = index - self.first
+        end = self.size if stop is None else max(stop - self.first, 0)
+        if start == -1 and self.prior is not None:
+            return (numpy.concatenate([[self.prior[0]], self.time[:end]]),
+                    numpy.concatenate([[self.prior[1]], self.value[:end]]))
+        start = max(start, 0)
+        return self.time[start:end], self.value[start:end]
+
+class SkeletonCache(object):
+    """
+    Prebuilt DAS_logs trees for new entries.
+
+    Creating the devices for an entry takes several hundred file system
+    operations, but the result only depends on the device definitions, the
+    values of the configuration fields and the scan axis.  The first entry
+    with a given configuration is created as usual and its DAS_logs tree is
+    copied into the cache.  Later entries with the same configuration copy
+    the tree in bulk and patch the start time, which is the only value that
+    changes from scan to scan.
+    """
+    def __init__(self):
+        self.root = None
+        self.skeletons = {}
+
+    def key(self, scan, state):
+        """
+        Hash of everything that goes into the DAS_logs tree, or None if
+        the inputs hold values which can't be hashed exactly, in which case
+        the entry is not cached.
+        """
+        inputs = [state.devices]
+        for device_name,device in sorted(state.devices.items()):
+            for field_name,field in sorted(device['fields'].items()):
+                source = "%s.%s"%(device_name,field_name)
+                mode = field.get('mode','configure')
+                if mode == 'configure':
+                    inputs.append((source, state.data.get(source, None)))
+                elif mode == 'counts':
+                    inputs.append((source, scan.scan_axis(state)))
+                for v in field.values():
+                    if _isstr(v) and v.startswith('->'):
+                        inputs.append((v, state.data.get(v.lstrip('->?'), None)))
+        try:
+            text = json.dumps(inputs, sort_keys=True, default=_key_value)
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha1(util.str_to_bytes(text)).hexdigest()
+
+    def get(self, key):
+        return self.skeletons.get(key, None)
+
+    def store(self, key, scan):
+        if self.root is None:
+            self.root = tempfile.mkdtemp()
+        skeleton = _Skeleton(os.path.join(self.root, key), scan)
+        self.skeletons[key] = skeleton
+        return skeleton
+
+    def clear(self):
+        self.skeletons.clear()
+        if self.root is not None:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.root = None
+
+def _key_value(obj):
+    """
+    JSON form of the non-JSON values in a skeleton key.  Arrays are hashed
+    in full, since their repr elides the middle of large arrays.
+    """
+    if isinstance(obj, numpy.ndarray) and obj.dtype != object:
+        return ['ndarray', obj.dtype.str, list(obj.shape),
+                hashlib.sha1(numpy.ascontiguousarray(obj).tobytes()).hexdigest()]
+    if isinstance(obj, numpy.generic):
+        return obj.item()
+    if isinstance(obj, bytes):
+        return ['bytes', repr(obj)]
+    raise TypeError("%r can't be part of a skeleton key" % (obj,))
+
+class _Skeleton(object):
+    """
+    Copy of the DAS_logs tree of a newly created entry, with the datasets
+    and sensor logs that go with it.
+    """
+    def __init__(self, path, scan):
+        self.path = path
+        self.start = _start_attr(scan.start)
+        shutil.copytree(_os_path(scan.das), path)
+        # Datasets are not written until the first point, so only the
+        # in-memory description needs to be kept.
+        self.fields = {}
+        for source,dataset in scan.fields.items():
+            template = copy.copy(dataset)
+            template.root = None
+            self.fields[source] = template
+        self.sensors = list(scan.sensor_list.keys())
+
+    def copy_to(self, scan, entry):
+        shutil.copytree(self.path, os.path.join(_os_path(entry), 'DAS_logs'))
+        scan.das = h5nexus.group(entry, 'DAS_logs', 'NXcollection')
+        start = _start_attr(scan.start)
+        for source,template in self.fields.items():
+            dataset = copy.copy(template)
+            dataset.root = scan.das
+            dataset.attrs = dict(template.attrs)
+            if dataset.attrs.get('start', None) == self.start:
+                dataset.attrs['start'] = start
+            scan.fields[source] = dataset
+        for sensor in self.sensors:
+            scan.sensor_list[sensor] = -1 # indicate new entry
+            scan.das[sensor.replace('.','/')+'/time'].attrs['start'] = start
+
+def _start_attr(start):
+    return iso8601.format_date(start*0.001, precision=3)
+
+def _os_path(node):
+    return os.path.join(node.os_path, node.path.lstrip("/"))
+
+def _tree_size(path):
+    """
+    Total size of the files below *path*.
+    """
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+def _as_point(value, dtype):
+    """
+    Return *value* as an array of one point of type *dtype*.  Contiguous
+    arrays of the right type, such as detector frames, are returned as a
+    view with a leading axis added rather than copied.
+    """
+    if (isinstance(value, numpy.ndarray) and value.flags.c_contiguous
+            and value.dtype == dtype):
+        return value.reshape((1,) + value.shape)
+    return numpy.asarray([value], dtype=dtype)
+
+def _resize(data, capacity):
+    result = numpy.empty(capacity, dtype=data.dtype)
+    result[:len(data)] = data
+    return result
+
 def _label(a,b,units):
     """
     Create a label like 'A3 setpoint (degrees)'
@@ -1008,42 +1935,100 @@ _SENSOR_STATS = [
     ]
 
 
+# Compiled NeXus mappings, keyed by the id of the mapping, least recently
+# used first.  Each holds on to its mapping so that the id isn't reused.
+MAX_STATIC_TREES = 8
+_STATIC_TREES = collections.OrderedDict() # id(config): (config, tree)
+_STATIC_TREES_LOCK = threading.Lock()
+
 def build_static_tree(das, path, config, data):
     """
     create group returning links to be made at the end
     """
     #print "creating group",path,config
     if not config: return []
-    links = []
-    for k,v in config.items():
-        #print "devices",k,v
-        if k.endswith("$NXlink"):
-            target_path = v
-            link_path = "/".join((path.name,k[:-7]))
-            links.append((target_path, link_path))
-        elif k.endswith("$DASlink"):
-            das_path = v.replace('.','/')
-            if das_path in das:
-                target = das[das_path]
-                link_path = "/".join((path.name,k[:-8]))
-                links.append((target.name,link_path))
-        elif "$NX" in k:
-            # If group is empty don't create it
-            if v is not None:
-                # subgroup name$NXclass
-                name, nxclass = k.split('$')
-                #print "creating",name,path
-                p = h5nexus.group(path, name, nxclass)
-                links += build_static_tree(das, p, v, data)
-        else:
-            try:
-                build_static_field(path, k, v)
-            except:
-                writer.warn("error while creating %s"%path.name, trace=True)                
-    return links
+    return compile_static_tree(config).build(das, path)
+
+def compile_static_tree(config):
+    """
+    Return the :class:`StaticTree` for the NeXus mapping *config*.
+
+    The mapping is interpreted once and the result is reused for every
+    entry written with the same mapping object, so a mapping must not be
+    changed in place once it has been used; a new configuration comes
+    with a new mapping.  The trees of the last :data:`MAX_STATIC_TREES`
+    mappings are kept.
+    """
+    key = id(config)
+    with _STATIC_TREES_LOCK:
+        item = _STATIC_TREES.pop(key, None)
+        if item is None:
+            item = (config, StaticTree(config))
+        _STATIC_TREES[key] = item
+        while len(_STATIC_TREES) > MAX_STATIC_TREES:
+            _STATIC_TREES.popitem(last=False)
+    return item[1]
+
+class StaticTree(object):
+    """
+    NeXus mapping flattened into a list of groups and fields to create,
+    and the links to make once the groups exist.  Paths are relative to
+    the group the tree is built in.
+    """
+    def __init__(self, config):
+        self.nodes = [] # (path, nxclass, None) for groups, (path, None, kw) for fields
+        self.links = [] # (target, link path, is DAS path)
+        self._compile("", config)
+
+    def _compile(self, path, config):
+        for k,v in config.items():
+            if k.endswith("$NXlink"):
+                self.links.append((v, _join(path,k[:-7]), False))
+            elif k.endswith("$DASlink"):
+                self.links.append((v.replace('.','/'), _join(path,k[:-8]), True))
+            elif "$NX" in k:
+                # If group is empty don't create it
+                if v is not None:
+                    # subgroup name$NXclass
+                    name, nxclass = k.split('$')
+                    self.nodes.append((_join(path,name), nxclass, None))
+                    if v: self._compile(_join(path,name), v)
+            else:
+                try:
+                    self.nodes.append((_join(path,k), None, _static_field_args(path, k, v)))
+                except:
+                    writer.warn("error while creating %s"%path, trace=True)
+
+    def build(self, das, path):
+        """
+        Create the groups and fields below *path*, returning the links to
+        be made at the end as (target path, link path) pairs.
+        """
+        for node_path,nxclass,kw in self.nodes:
+            if kw is None:
+                h5nexus.group(path, node_path, nxclass)
+            else:
+                try:
+                    kw = dict(kw, attrs=dict(kw['attrs']))
+                    h5nexus.field(path, node_path, **kw)
+                except:
+                    writer.warn("error while creating %s"%path.name, trace=True)
+        links = []
+        for target,link_path,is_das in self.links:
+            if is_das:
+                target = "/".join((das.name,target))
+            links.append((target, "/".join((path.name,link_path))))
+        return links
+
+def _join(path, name):
+    return "/".join((path,name)) if path else name
 
 def build_static_field(path, name, conf):
     #print "make field",path,name,conf
+    kw = _static_field_args(path.name, name, conf)
+    h5nexus.field(path, name, **kw)
+
+def _static_field_args(path, name, conf):
     dtype = conf.get('type',None)
     value = conf.get('value', None)
     attrs = conf.get('attrs', {})
@@ -1072,18 +2057,14 @@ def build_static_field(path, name, conf):
          value = util.str_to_bytes(value)
     attrs = dict((k,v['value']) for k,v in attrs.items()
                  if k not in set(('units','long_name')))
-    h5nexus.field(path, name, data=value, units=units, dtype=dtype,
-                label=label, attrs=attrs)
+    return dict(data=value, units=units, dtype=dtype, label=label, attrs=attrs)
 
 def make_links(entry, links):
-    for target_path,link_path in links:
-        try:
-            target = entry[target_path]
-        except KeyError:
-            continue
-        
-                
-        #print "linking",sourcepath,target
-        h5nexus.link(target,link_path)
+    # Targets may be given relative to the entry; the links are made in one
+    # batch, skipping targets which don't exist.
+    links = [(target_path if target_path.startswith("/")
+              else "/".join((entry.name,target_path)), link_path)
+             for target_path,link_path in links]
+    h5nexus.make_links(entry, links)
 
 def _isstr(s): return isinstance(s, str)